@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def get_path_identity(path):
+    """List relative path, size, and modification time of each file under path."""
+
+    path = Path(path)
+    files = (
+        [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+    )
+
+    # Table lock files are rewritten whenever a table is opened
+    files = [file for file in files if file.name != "table.lock"]
+
+    identity = []
+    for file in files:
+        stat = file.stat()
+        identity.append(
+            [str(file.relative_to(path.parent)), stat.st_size, stat.st_mtime_ns]
+        )
+
+    return identity
+
+
+def get_cache_key(ms, options):
+    """Hash identity of MS tables and normalised extraction options into a cache key."""
+
+    content = {
+        "ms": get_path_identity(ms),
+        "options": options,
+    }
+    encoded = json.dumps(content, sort_keys=True, default=str).encode()
+
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def get_entry_size(entry):
+    return sum(file.stat().st_size for file in entry.iterdir())
+
+
+def fetch_cache(cache_dir, key, outfiles):
+    """Copy cached products matching key to outfiles, returning whether the key was found."""
+
+    entry = Path(cache_dir) / key
+    cached = [entry / f"{i}.hdf5" for i in range(len(outfiles))]
+    if not all(file.exists() for file in cached):
+        return False
+
+    for file, outfile in zip(cached, outfiles):
+        shutil.copyfile(file, outfile)
+
+    # Mark entry as recently used
+    entry.touch()
+    logger.info(f"Found cached extraction {key[:12]} in {cache_dir}")
+
+    return True
+
+
+def store_cache(cache_dir, key, outfiles, max_size):
+    """Copy products into cache under key, evicting least recently used entries beyond max_size in GB."""
+
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / key
+
+    # Write into a temporary entry of this run so that partial copies are
+    # never fetched, nor mixed with those of concurrent runs
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = Path(tempfile.mkdtemp(dir=cache_dir, prefix=f".{key}."))
+    try:
+        for i, outfile in enumerate(outfiles):
+            shutil.copyfile(outfile, partial / f"{i}.hdf5")
+
+        # Entries of the same key hold the same products, so it is fine to
+        # lose the rename to a concurrent run storing the same entry
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(partial, entry)
+        except OSError:
+            logger.debug(f"Extraction {key[:12]} already stored in {cache_dir}")
+        else:
+            logger.debug(f"Stored extraction {key[:12]} in {cache_dir}")
+    finally:
+        shutil.rmtree(partial, ignore_errors=True)
+
+    evict_cache(cache_dir, max_size)
+
+    return
+
+
+def evict_cache(cache_dir, max_size):
+    """Remove least recently used cache entries until cache is within max_size in GB."""
+
+    entries = [entry for entry in Path(cache_dir).iterdir() if entry.is_dir()]
+    entries = sorted(
+        (entry for entry in entries if not entry.name.startswith(".")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+
+    sizes = [get_entry_size(entry) for entry in entries]
+    total = sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if total <= max_size * 1024**3:
+            break
+
+        logger.debug(f"Evicting cached extraction {entry.name[:12]}")
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+    return
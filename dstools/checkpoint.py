@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from dstools.cache import get_path_identity
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def resumable_directory(parent, key):
+    """Scratch directory named by key, kept if the run fails so that it can be resumed."""
+
+    path = Path(parent) / f"dstools-{key[:16]}"
+    path.mkdir(parents=True, exist_ok=True)
+
+    yield str(path)
+
+    shutil.rmtree(path)
+
+
+@dataclass
+class Checkpoint:
+    """Progress of an extraction, saved after each step so an interrupted run can resume.
+
+    A checkpoint without a path is never saved, so that runs which cannot be
+    resumed share the same code path.
+    """
+
+    path: Optional[Path] = None
+    temporaries: dict = field(default_factory=dict)
+    times: Optional[list] = None
+    offset: int = 0
+    windows: Optional[list] = None
+    completed: list = field(default_factory=list)
+    uvsum: list = field(default_factory=list)
+    uvcount: list = field(default_factory=list)
+
+    @classmethod
+    def load(cls, scratch):
+        """Load checkpoint of an interrupted run from its scratch directory."""
+
+        path = Path(scratch) / "checkpoint.json"
+        if not path.exists():
+            return cls(path)
+
+        state = json.loads(path.read_text())
+        state["windows"] = state["windows"] and [
+            [tuple(block) for block in window] for window in state["windows"]
+        ]
+        state["completed"] = [tuple(block) for block in state["completed"]]
+
+        return cls(path, **state)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @property
+    def started(self):
+        return self.windows is not None
+
+    def save(self):
+        """Atomically write checkpoint so that it is never left partially written."""
+
+        if not self.enabled:
+            return
+
+        state = asdict(self)
+        del state["path"]
+
+        partial = self.path.with_suffix(".partial")
+        partial.write_text(json.dumps(state, default=int))
+        os.replace(partial, self.path)
+
+    def get_temporary(self, name):
+        """Get path of a temporary product, if it still exists unmodified."""
+
+        path, identity = self.temporaries.get(name, (None, None))
+        if path is None or not os.path.exists(path):
+            return None
+
+        # Temporaries written by an interrupted process may be incomplete
+        if get_path_identity(path) != identity:
+            logger.warning(f"Discarding modified temporary {path}")
+            return None
+
+        return path
+
+    def add_temporary(self, name, path):
+        """Record a completed temporary product so that a resumed run can reuse it."""
+
+        if not self.enabled:
+            return
+
+        self.temporaries[name] = (str(path), get_path_identity(path))
+        self.save()
+
+    def start(self, times, offset, windows, uvsum=0, uvcount=0):
+        """Record the integrations and row blocks being extracted.
+
+        UV distance sums start from those of rows already in the DS, if appending.
+        """
+
+        self.times = [float(t) for t in times]
+        self.offset = int(offset)
+        self.windows = windows
+        self.uvsum = np.asarray(uvsum).tolist()
+        self.uvcount = np.asarray(uvcount).tolist()
+        self.save()
+
+    def complete(self, block, uvsum, uvcount):
+        """Record a block written to disk along with the running UV distance sums."""
+
+        self.completed.append(tuple(block))
+        self.uvsum = uvsum.tolist()
+        self.uvcount = uvcount.tolist()
+        self.save()
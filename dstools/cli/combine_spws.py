@@ -16,7 +16,10 @@ def main(ms, outputvis):
     casa_bin = shutil.which("casa")
 
     call = f"{casa_bin} --nologger --nologfile -c {path} {ms} {outputvis}".split(" ")
-    subprocess.run(call)
+    result = subprocess.run(call)
+
+    # Pass on exit status of CASA so that failures can be detected
+    exit(result.returncode)
 
 
 if __name__ == "__main__":
@@ -1,33 +1,69 @@
-import itertools as it
 import logging
 import os
-import warnings
-from concurrent.futures import ProcessPoolExecutor, wait
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, nullcontext
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
+from typing import Optional
 
+import astropy.constants as c
 import click
 import h5py
 import numpy as np
+import pandas as pd
 from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.wcs import WCS, FITSFixedWarning
+from astropy.time import Time
+from casacore.images import image as casaimage
 from casacore.tables import table
 
 import dstools
+from dstools.cache import fetch_cache, get_cache_key, get_path_identity, store_cache
+from dstools.checkpoint import Checkpoint, resumable_directory
+from dstools.dynamic_spectrum import rebin
 from dstools.logger import setupLogger
+from dstools.taskqueue import TaskQueue
+from dstools.timing import Stage, TimingReport, get_peak_rss
 from dstools.utils import parse_coordinates
 
-warnings.filterwarnings("ignore", category=FITSFixedWarning, append=True)
-
 DSTOOLS_PATH = dstools.__path__[0]
 
 logger = logging.getLogger(__name__)
 
+# Correlation names of Stokes types in POLARIZATION::CORR_TYPE
+CORRELATION_TYPES = {
+    5: "RR",
+    6: "RL",
+    7: "LR",
+    8: "LL",
+    9: "XX",
+    10: "XY",
+    11: "YX",
+    12: "YY",
+}
+
+# Per-worker state holding open MS table and shared output cube
+_worker = threading.local()
 
-def get_header_properties(ms, datacolumn, pb_scale):
+
+def get_header_properties(
+    ms,
+    datacolumn,
+    pb_scale,
+    phasecentre=None,
+    query=None,
+    chanrange=None,
+):
 
     # Calculate data dimensions
-    times, freqs, antennas, nbaselines = get_data_dimensions(ms)
+    times, freqs, antennas, nbaselines = get_data_dimensions(ms, query, chanrange)
 
     # Infer polarisation of feeds
     feedtype = get_feed_polarisation(ms)
@@ -37,15 +73,9 @@ def get_header_properties(ms, datacolumn, pb_scale):
     telescope = ta.getcol("TELESCOPE_NAME")[0]
     ta.close()
 
-    # Parse phasecentre direction
-    ta = table(f"{ms}::FIELD", ack=False)
-    phasecentre_coords = ta.getcol("PHASE_DIR")[0][0]
-    phasecentre = SkyCoord(
-        ra=phasecentre_coords[0],
-        dec=phasecentre_coords[1],
-        unit="rad",
-    )
-    ta.close()
+    # Parse phasecentre direction, unless rotating to a new phasecentre
+    if phasecentre is None:
+        phasecentre = get_phasecentre(ms)
 
     # Create header
     ncorrelations = nbaselines * len(freqs) * len(times) * 4
@@ -66,6 +96,20 @@ def get_header_properties(ms, datacolumn, pb_scale):
     return header
 
 
+def get_phasecentre(ms):
+
+    ta = table(f"{ms}::FIELD", ack=False)
+    phasecentre_coords = ta.getcol("PHASE_DIR")[0][0]
+    phasecentre = SkyCoord(
+        ra=phasecentre_coords[0],
+        dec=phasecentre_coords[1],
+        unit="rad",
+    )
+    ta.close()
+
+    return phasecentre
+
+
 def get_feed_polarisation(ms):
 
     tf = table(f"{ms}::FEED", ack=False)
@@ -87,26 +131,101 @@ def get_feed_polarisation(ms):
     return feedtype
 
 
-def combine_spws(ms):
+def combine_spws(ms, scratch, checkpoint=None):
+
+    # Reuse MS combined by an interrupted run
+    checkpoint = checkpoint or Checkpoint()
+    combined = checkpoint.get_temporary("combined")
+    if combined is not None:
+        logger.info(f"Resuming with spectral windows already combined in {combined}")
+        return combined
+
+    # Run CASA within scratch directory so its logs and .last files stay there,
+    # replacing any incomplete output of an interrupted run
+    outvis = f"{scratch}/{Path(ms).stem}.comb.ms"
+    shutil.rmtree(outvis, ignore_errors=True)
+    result = subprocess.run(
+        ["_dstools-combine-spws", os.path.abspath(ms), outvis],
+        cwd=scratch,
+        stdout=subprocess.DEVNULL,
+    )
+
+    # Only record a complete combined MS to be reused if resumed. CASA may
+    # exit cleanly after a failed task, leaving no output
+    if result.returncode != 0 or not os.path.exists(outvis):
+        logger.error(f"Combining spectral windows of {ms} with CASA failed")
+        exit(1)
 
-    outvis = ms.replace(".ms", ".dstools-temp.comb.ms")
-    os.system(f"_dstools-combine-spws {ms} {outvis} 1>/dev/null")
+    checkpoint.add_temporary("combined", outvis)
 
     return outvis
 
 
-def get_data_dimensions(ms):
+def get_spectral_windows(ms, chanrange=None):
+    """Map each data description onto a channel range of the combined frequency axis."""
+
+    tab = table(ms, ack=False, lockoptions="autonoread")
+    ddids = np.unique(tab.getcol("DATA_DESC_ID"))
+    tab.close()
+
+    td = table(f"{ms}::DATA_DESCRIPTION", ack=False)
+    spws = td.getcol("SPECTRAL_WINDOW_ID")[ddids]
+    td.close()
+
+    ts = table(f"{ms}::SPECTRAL_WINDOW", ack=False)
+    spw_freqs = [ts.getcell("CHAN_FREQ", spw) for spw in spws]
+    ts.close()
+
+    # Optionally select the same range of channels from each spectral window
+    if chanrange is not None:
+        start, end = chanrange
+        if not 0 <= start <= end < min(len(freqs) for freqs in spw_freqs):
+            raise ValueError(f"Channel range {start}-{end} outside of {ms}.")
+
+        spw_freqs = [freqs[start : end + 1] for freqs in spw_freqs]
+
+    # Channels are stored in their native order, so spectral windows with
+    # descending channels (e.g. ATCA) are concatenated in descending order
+    # to keep the combined frequency axis monotonic
+    directions = {
+        np.sign(freqs[-1] - freqs[0]) for freqs in spw_freqs if len(freqs) > 1
+    }
+    if len(directions) > 1:
+        raise ValueError(
+            f"Cannot combine ascending and descending spectral windows of {ms}."
+        )
+
+    # Concatenate spectral windows in order of frequency
+    order = np.argsort([freqs.min() for freqs in spw_freqs])
+    if directions == {-1}:
+        order = order[::-1]
+    nchans = np.array([len(spw_freqs[i]) for i in order])
+
+    chan_offsets = np.full(ddids.max() + 1, -1)
+    chan_offsets[ddids[order]] = np.cumsum(nchans) - nchans
+    freqs = np.concatenate([spw_freqs[i] for i in order])
+
+    return freqs, chan_offsets, nchans
+
+
+def get_data_dimensions(ms, query=None, chanrange=None):
 
     # Get antenna count and time / frequency arrays
     tab = table(ms, ack=False, lockoptions="autonoread")
 
-    # Throw away autocorrelations
-    tab = tab.query("ANTENNA1 != ANTENNA2")
+    # Throw away autocorrelations and optionally unselected rows
+    autocorr_query = "ANTENNA1 != ANTENNA2"
+    tab = tab.query(
+        autocorr_query if query is None else f"{autocorr_query} AND {query}"
+    )
+
+    if tab.nrows() == 0:
+        tab.close()
+        raise ValueError(f"No cross-correlations of {ms} match selection.")
 
     # Get time, frequency, and baseline axes
     times = np.unique(tab.getcol("TIME"))
-    tf = table(f"{ms}::SPECTRAL_WINDOW", ack=False)
-    freqs = tf[0]["CHAN_FREQ"]
+    freqs, _, _ = get_spectral_windows(ms, chanrange)
 
     antennas = np.unique(
         np.append(
@@ -115,7 +234,6 @@ def get_data_dimensions(ms):
         ),
     )
 
-    tf.close()
     tab.close()
 
     # Calculate number of baselines
@@ -124,6 +242,77 @@ def get_data_dimensions(ms):
     return times, freqs, antennas, nbaselines
 
 
+def get_antenna_indices(ms, antennas):
+    """Convert comma-separated antenna names or indices into antenna indices."""
+
+    ta = table(f"{ms}::ANTENNA", ack=False)
+    names = list(ta.getcol("NAME"))
+    ta.close()
+
+    indices = []
+    for antenna in antennas.split(","):
+        antenna = antenna.strip()
+        if antenna in names:
+            indices.append(names.index(antenna))
+        elif antenna.isdigit() and int(antenna) < len(names):
+            indices.append(int(antenna))
+        else:
+            raise ValueError(f"Antenna {antenna} not found in {ms}.")
+
+    return sorted(set(indices))
+
+
+def parse_timerange(timerange):
+    """Convert start and end times given as MJD or ISO format into MS TIME in seconds."""
+
+    times = []
+    for value in timerange:
+        try:
+            time = Time(float(value), format="mjd")
+        except ValueError:
+            time = Time(value)
+
+        times.append(float(time.utc.mjd * 86400))
+
+    return times
+
+
+def get_selection_query(ms, antennas=None, timerange=None):
+    """Construct TaQL query selecting rows by antenna and time range."""
+
+    conditions = []
+
+    if antennas is not None:
+        indices = get_antenna_indices(ms, antennas)
+        conditions.append(f"ANTENNA1 IN {indices} AND ANTENNA2 IN {indices}")
+
+    if timerange is not None:
+        tmin, tmax = parse_timerange(timerange)
+        conditions.append(f"TIME >= {tmin!r} AND TIME <= {tmax!r}")
+
+    return " AND ".join(conditions) if conditions else None
+
+
+def get_correlation_indices(ms, correlations=None):
+    """Locate comma-separated correlations (e.g. XX,YY) on the polarisation axis of the MS."""
+
+    if correlations is None:
+        return None
+
+    tp = table(f"{ms}::POLARIZATION", ack=False)
+    corr_types = [CORRELATION_TYPES.get(corr) for corr in tp.getcell("CORR_TYPE", 0)]
+    tp.close()
+
+    selected = [corr.strip().upper() for corr in correlations.split(",")]
+    missing = [corr for corr in selected if corr not in corr_types]
+    if missing:
+        raise ValueError(
+            f"Correlations {', '.join(missing)} not in {ms}, which has {corr_types}."
+        )
+
+    return np.array(sorted({corr_types.index(corr) for corr in selected}))
+
+
 def validate_datacolumn(ms, datacolumn):
 
     tab = table(ms, ack=False, lockoptions="autonoread")
@@ -133,250 +322,2320 @@ def validate_datacolumn(ms, datacolumn):
     return col_exists
 
 
-def rotate_phasecentre(ms, ra, dec):
-    logger.debug(f"Rotating phasecentre to {ra} {dec}")
+def read_catalogue(catalogue):
+    """Read target names and positions from a CSV catalogue with name, ra, and dec columns."""
+
+    targets = pd.read_csv(catalogue, dtype=str, skipinitialspace=True)
+    targets.columns = targets.columns.str.strip().str.lower()
+
+    if not {"ra", "dec"}.issubset(targets.columns):
+        raise ValueError(f"Catalogue {catalogue} must contain ra and dec columns.")
+
+    # Name targets by catalogue row if not supplied
+    if "name" not in targets.columns:
+        targets["name"] = [f"target{i}" for i in range(len(targets))]
+
+    names = targets["name"].str.strip().tolist()
+    positions = [
+        parse_coordinates((ra, dec)) for ra, dec in zip(targets.ra, targets.dec)
+    ]
+
+    return names, positions
+
+
+def get_target_path(outfile, name):
+    """Construct path of DS for a named catalogue target from the output path."""
+
+    path = Path(outfile)
+    name = name.replace(" ", "_").replace("/", "_")
+
+    return str(path.with_name(f"{path.stem}_{name}{path.suffix}"))
+
+
+def get_targets(phasecentre, catalogue, outfile):
+    """Get positions and DS paths of each target, with no positions if not rotating."""
+
+    if catalogue is not None and phasecentre is not None:
+        logger.error("Provide either a phasecentre or a catalogue of targets, not both")
+        exit(1)
+
+    if catalogue is not None:
+        names, positions = read_catalogue(catalogue)
+        logger.debug(f"Extracting {len(positions)} targets from {catalogue}")
+
+        # Names differing only in characters replaced in paths would
+        # overwrite the DS of another target
+        outfiles = [get_target_path(outfile, name) for name in names]
+        duplicates = sorted(
+            {path for path, count in Counter(outfiles).items() if count > 1}
+        )
+        if duplicates:
+            logger.error(
+                f"Targets in {catalogue} share output paths {', '.join(duplicates)},"
+                " rename them so that each has its own DS"
+            )
+            exit(1)
+
+        return positions, outfiles
+
+    if phasecentre is not None:
+        return [parse_coordinates(phasecentre)], [outfile]
+
+    return [], [outfile]
+
+
+def get_target_headers(ms, header, positions, primary_beam=None):
+    """Get header, primary beam correction, and phase offset of each target."""
+
+    if not positions:
+        return [header], np.ones(1), None
+
+    ra, dec = map(list, zip(*positions))
+    phasecentres = SkyCoord(ra=ra, dec=dec, unit=("hourangle", "deg"))
+    phase_offsets = get_phase_offset(ms, phasecentres)
+    pb_scales = get_pb_correction(primary_beam, ra, dec)
+    headers = [
+        header
+        | {
+            "phasecentre": target.to_string("hmsdms"),
+            "pb_scale": pb_scale,
+        }
+        for target, pb_scale in zip(phasecentres, pb_scales)
+    ]
+
+    return headers, pb_scales, phase_offsets
+
+
+def get_phase_offset(ms, phasecentre):
+    """Calculate direction cosines (l, m, n - 1) of one or more phasecentres relative to MS phasecentre."""
+
+    ms_phasecentre = get_phasecentre(ms)
+
+    ra, dec = phasecentre.ra.rad, phasecentre.dec.rad
+    ra0, dec0 = ms_phasecentre.ra.rad, ms_phasecentre.dec.rad
+
+    dra = ra - ra0
+    lmn = np.stack(
+        [
+            np.cos(dec) * np.sin(dra),
+            np.sin(dec) * np.cos(dec0) - np.cos(dec) * np.sin(dec0) * np.cos(dra),
+            np.sin(dec) * np.sin(dec0) + np.cos(dec) * np.cos(dec0) * np.cos(dra),
+        ],
+        axis=-1,
+    )
+
+    return lmn - [0, 0, 1]
+
+
+def rotate_visibilities(data, uvw, freqs, phase_offsets):
+    """Shift phase of visibilities to each phasecentre offset by (l, m, n - 1)."""
 
-    # Apply phasecentre rotation
-    os.system(f"_dstools-rotate -- {ms} {ra} {dec} 1>/dev/null")
+    # Geometric delay of each new phasecentre in metres for each row, converted
+    # to a phase in each channel following the exp(-2πi(ul + vm + w(n-1)))
+    # visibility sign convention of the MS
+    delay = uvw @ phase_offsets.T
+    phase = 2 * np.pi * delay[:, :, np.newaxis] * np.expand_dims(freqs, -2) / c.c.value
+    phasor = np.exp(1j * phase).astype(data.dtype, copy=False)
 
-    # Use rotated MeasurementSet for subsequent processing
-    rotated_ms = ms.replace(".ms", ".dstools-temp.rotated.ms")
+    # Rotated visibilities gain a target axis after the row axis
+    return data[:, np.newaxis] * phasor[:, :, :, np.newaxis]
 
-    return rotated_ms
+
+@lru_cache(maxsize=8)
+def open_primary_beam(primary_beam, identity=None):
+    """Open CASA or FITS primary beam image, reusing the handle across calls.
+
+    Handles are keyed on the identity of the image files as well as the path,
+    so that an image rewritten in place (e.g. between batch jobs) is reopened.
+    """
+
+    pb = casaimage(primary_beam)
+
+    # Locate RA and Dec on the world axes, holding any other axes
+    # (e.g. frequency and Stokes) at their first pixel
+    axes = []
+    for coord_axes in pb.coordinates().get_axes():
+        axes += [coord_axes] if isinstance(coord_axes, str) else coord_axes
+    ra_axis, dec_axis = axes.index("Right Ascension"), axes.index("Declination")
+    refworld = pb.toworld([0] * len(pb.shape()))
+
+    return pb, ra_axis, dec_axis, refworld
 
 
 def get_pb_correction(primary_beam, ra, dec):
+    """Look up primary beam gain at one or more positions, reading only the needed pixels."""
+
+    positions = SkyCoord(
+        ra=np.atleast_1d(ra),
+        dec=np.atleast_1d(dec),
+        unit=("hourangle", "deg"),
+    )
+    scales = np.ones(len(positions))
 
     if primary_beam is None:
-        return 1
-
-    position = SkyCoord(ra=ra, dec=dec, unit=("hourangle", "deg"))
-
-    if ".fits" not in primary_beam:
-        pbfits = primary_beam + ".dstools.fits"
-        cmd = f'exportfits(imagename="{primary_beam}", fitsimage="{pbfits}", overwrite=True)'
-        os.system(f"casa --nologger --nologfile -c '{cmd}' 1>/dev/null")
-        primary_beam = pbfits
-
-    with fits.open(primary_beam) as hdul:
-        header, data = hdul[0].header, hdul[0].data
-        data = data[0, 0, :, :]
-
-    if "dstools" in primary_beam:
-        os.system(f"rm {pbfits} 2>/dev/null")
-
-    wcs = WCS(header, naxis=2)
-    x, y = wcs.wcs_world2pix(position.ra, position.dec, 1)
-    x, y = int(x // 1), int(y // 1)
-    xmax, ymax = data.shape
-
-    # Check position is within limits of supplied PB image
-    im_outside_limit = [
-        x < 0,
-        x > xmax,
-        y < 0,
-        y > ymax,
+        return scales
+
+    identity = tuple(map(tuple, get_path_identity(primary_beam)))
+    pb, ra_axis, dec_axis, refworld = open_primary_beam(primary_beam, identity)
+    shape = pb.shape()
+
+    for i, position in enumerate(positions):
+        world = list(refworld)
+        world[ra_axis], world[dec_axis] = position.ra.rad, position.dec.rad
+        pixel = np.round(pb.topixel(world)).astype(int).tolist()
+
+        # Check position is within limits of supplied PB image
+        if any(p < 0 or p >= n for p, n in zip(pixel, shape)):
+            logger.warning(
+                f"Position {position.to_string('hmsdms')} outside of supplied PB image, disabling PB correction."
+            )
+            continue
+
+        scale = pb.getdata(blc=pixel, trc=pixel).item()
+        if pb.getmask(blc=pixel, trc=pixel).item() or not np.isfinite(scale):
+            logger.warning(
+                f"Position {position.to_string('hmsdms')} masked in supplied PB image, disabling PB correction."
+            )
+            continue
+
+        logger.debug(
+            f"PB correction scale {scale:.4f} measured at pixel {pixel} in image of size {shape}"
+        )
+        scales[i] = scale
+
+    return scales
+
+
+def get_weight_column(ms):
+    """Get column of visibility weights, preferring weights of each channel if stored."""
+
+    tab = table(ms, ack=False, lockoptions="autonoread")
+    columns = [
+        column
+        for column in ["WEIGHT_SPECTRUM", "WEIGHT"]
+        if column in tab.colnames() and tab.nrows() > 0 and tab.iscelldefined(column, 0)
     ]
-    if any(im_outside_limit):
-        logger.warning(
-            f"Position {ra} {dec} outside of supplied PB image, disabling PB correction."
+    tab.close()
+
+    return columns[0] if columns else None
+
+
+def get_baseline_lookup(ms, antennas, baseline_average=False):
+    """Construct lookup table mapping antenna pairs to their baseline index."""
+
+    # Size table by full antenna list so any ANTENNA1/2 value can be looked up
+    ta = table(f"{ms}::ANTENNA", ack=False)
+    nant = max(ta.nrows(), antennas.max() + 1)
+    ta.close()
+
+    # Baseline indices follow the ordering of it.combinations(antennas, 2),
+    # with autocorrelations and unselected antennas mapped to -1
+    ant1_idx, ant2_idx = np.triu_indices(len(antennas), k=1)
+    lookup = np.full((nant, nant), -1)
+    lookup[antennas[ant1_idx], antennas[ant2_idx]] = np.arange(len(ant1_idx))
+
+    # Map all baselines onto a single baseline if averaging
+    if baseline_average:
+        lookup[lookup >= 0] = 0
+
+    return lookup
+
+
+@dataclass
+class RowReader:
+    """Reads blocks of MS rows and locates them within the DS axes."""
+
+    datacolumn: str
+    times: np.ndarray
+    freqs: np.ndarray
+    lookup: np.ndarray
+    chan_offsets: np.ndarray
+    phase_offsets: Optional[np.ndarray] = None
+    noflag: bool = False
+    baseline_average: bool = False
+    minuvdist: float = 0
+    query: Optional[str] = None
+    chanrange: Optional[tuple] = None
+    correlations: Optional[np.ndarray] = None
+    weightcolumn: Optional[str] = None
+
+    def read_cells(self, tab, column, startrow, nrow, stage):
+        """Read selected channels and correlations of an array column."""
+
+        if self.chanrange is None and self.correlations is None:
+            cells = tab.getcol(column, startrow=startrow, nrow=nrow)
+            stage.bytes_read += cells.nbytes
+            return cells
+
+        # An axis spanning -1 to -1 is read in full
+        chanstart, chanend = (-1, -1) if self.chanrange is None else self.chanrange
+        polstart, polend, polstep = -1, -1, 1
+
+        # Read evenly spaced correlations (e.g. XX,YY or XY,YX) with a stride,
+        # otherwise read the range spanning them and select afterwards
+        if self.correlations is not None:
+            polstart, polend = self.correlations[0], self.correlations[-1]
+            polstep = max(np.gcd.reduce(np.diff(self.correlations)), 1)
+
+        cells = tab.getcolslice(
+            column,
+            [chanstart, polstart],
+            [chanend, polend],
+            [1, polstep],
+            startrow=startrow,
+            nrow=nrow,
+        )
+        stage.bytes_read += cells.nbytes
+
+        if self.correlations is None:
+            return cells
+
+        # Unselected correlations are left missing and flagged
+        fill = True if cells.dtype == bool else np.nan
+        selected = np.full((*cells.shape[:-1], 4), fill, dtype=cells.dtype)
+        selected[..., self.correlations] = cells[
+            ..., (self.correlations - polstart) // polstep
+        ]
+
+        return selected
+
+    def select_channels(self, first, last):
+        """Restrict reader to a range of the selected channels of each spectral window."""
+
+        start = 0 if self.chanrange is None else self.chanrange[0]
+
+        return replace(
+            self,
+            chanrange=(start + first, start + last),
+            chan_offsets=self.chan_offsets + first,
         )
-        return 1
 
-    scale = data[x, y]
+    def read_columns(self, tab, startrow, nrow, stage):
+        """Read the columns of a block of rows needed to fill the DS."""
+
+        columns = {
+            column: tab.getcol(column, startrow=startrow, nrow=nrow)
+            for column in ["ANTENNA1", "ANTENNA2", "TIME", "DATA_DESC_ID", "UVW"]
+        }
+        columns["data"] = self.read_cells(tab, self.datacolumn, startrow, nrow, stage)
+        columns["flags"] = self.read_cells(tab, "FLAG", startrow, nrow, stage)
+
+        # Weights of each channel, or of all channels, for averaging baselines
+        if self.baseline_average and self.weightcolumn == "WEIGHT_SPECTRUM":
+            columns["weights"] = self.read_cells(
+                tab, self.weightcolumn, startrow, nrow, stage
+            )
+        elif self.baseline_average and self.weightcolumn == "WEIGHT":
+            weights = tab.getcol(self.weightcolumn, startrow=startrow, nrow=nrow)
+            stage.bytes_read += weights.nbytes
+            columns["weights"] = weights[:, np.newaxis]
+
+        return columns
+
+    def process_rows(self, tab, startrow=0, nrow=-1, report=None, lock=None):
+        """Read a block of rows and locate them within the baseline / time axes.
+
+        If given a lock, it is only held while reading from the MS.
+        """
+
+        report = report if report is not None else TimingReport()
+
+        with report.time("read") as stage:
+            # casacore is not thread-safe, so threads must take turns reading
+            # the MS, while processing the rows they have read concurrently
+            with lock if lock is not None else nullcontext():
+                columns = self.read_columns(tab, startrow, nrow, stage)
+
+            # Map each row onto the baseline, time, and frequency axes
+            ant1 = columns["ANTENNA1"]
+            ant2 = columns["ANTENNA2"]
+            row_times = columns["TIME"]
+            ddid = columns["DATA_DESC_ID"]
+
+            bl_idx = self.lookup[ant1, ant2]
+            time_idx = np.searchsorted(self.times, row_times)
+            chan_idx = self.chan_offsets[ddid]
+
+            # Throw away autocorrelations
+            rowmask = bl_idx >= 0
+
+            # Throw away short baselines if averaging, selecting on
+            # projected uv distance as in a CASA uvrange selection
+            uvw = columns["UVW"]
+            if self.baseline_average:
+                rowmask &= np.hypot(uvw[:, 0], uvw[:, 1]) > self.minuvdist
+
+            # Calculate UV distance of each row
+            uvw = uvw[rowmask]
+            uvdist = np.sqrt(np.sum(np.square(uvw), axis=1))
+
+            stage.rows += len(ant1)
+
+            data = columns["data"][rowmask]
+            flags = columns["flags"][rowmask]
+            weights = columns.get("weights")
+            chan_idx = chan_idx[rowmask]
+
+        # Optionally rotate phasecentre to each set of new coordinates,
+        # otherwise data has a single target at the MS phasecentre
+        if self.phase_offsets is not None:
+            with report.time("rotate") as stage:
+                row_freqs = self.freqs[
+                    chan_idx[:, np.newaxis] + np.arange(data.shape[1])
+                ]
+                data = rotate_visibilities(data, uvw, row_freqs, self.phase_offsets)
+                stage.rows += len(data)
+        else:
+            data = data[:, np.newaxis]
+
+        rows = {
+            "baseline": bl_idx[rowmask],
+            "time": time_idx[rowmask],
+            "channel": chan_idx,
+            "uvdist": uvdist,
+            "data": data,
+            "flags": flags,
+        }
+        if weights is not None:
+            rows["weights"] = weights[rowmask]
+
+        # Optionally average over baselines, applying flags beforehand
+        # as otherwise they are stored alongside the unflagged data. The
+        # unflagged data is also averaged, following the targets along
+        # the target axis, so that flags can still be ignored when loaded
+        if self.baseline_average:
+            with report.time("average") as stage:
+                if not self.noflag:
+                    flagged = data.copy()
+                    flagmask = np.broadcast_to(flags[:, np.newaxis], data.shape)
+                    flagged[flagmask] = np.nan
+                    rows["data"] = np.concatenate([flagged, data], axis=1)
+
+                stage.rows += len(data)
+                rows = self.average_baselines(rows)
+
+        return rows
+
+    def average_baselines(self, rows):
+        """Average unflagged visibilities over all baselines in each integration.
+
+        Visibilities are weighted by their weights if read, as in CASA averaging.
+        """
+
+        averaged = defaultdict(list)
+        for chan_idx, spw_rows in split_spectral_windows(rows):
+            # Rows are time-ordered, so each integration is a contiguous group
+            time_idx, starts = np.unique(spw_rows["time"], return_index=True)
+            nrows = np.diff(np.append(starts, len(spw_rows["time"])))
+
+            data = spw_rows["data"]
+            valid = np.isfinite(data)
+            data[~valid] = 0
+
+            # Flagged and missing visibilities have no weight
+            weights = valid.astype(float)
+            if "weights" in spw_rows:
+                weights *= np.nan_to_num(spw_rows["weights"][:, np.newaxis])
+
+            sums = np.add.reduceat(data * weights, starts, axis=0, dtype=complex)
+            weightsums = np.add.reduceat(weights, starts, axis=0)
+
+            # Fully flagged channels are left as NaN
+            with np.errstate(invalid="ignore", divide="ignore"):
+                data = sums / weightsums
+
+            averaged["baseline"].append(np.zeros(len(time_idx), dtype=int))
+            averaged["time"].append(time_idx)
+            averaged["channel"].append(np.full(len(time_idx), chan_idx))
+            averaged["uvdist"].append(
+                np.add.reduceat(spw_rows["uvdist"], starts) / nrows
+            )
+            averaged["data"].append(data)
+            averaged["flags"].append(weightsums[:, 0] == 0)
+
+        if not averaged:
+            return rows
+
+        return {key: np.concatenate(val) for key, val in averaged.items()}
+
+
+def split_spectral_windows(rows):
+    """Split a block of rows into groups sharing the same channel offset."""
+
+    chan_offsets = np.unique(rows["channel"])
+
+    # Avoid copying the block if it only contains one spectral window
+    if len(chan_offsets) == 1:
+        yield chan_offsets[0], rows
+        return
 
-    logger.debug(
-        f"PB correction scale {scale:.4f} measured at pixel {x},{y} in image of size {xmax},{ymax}"
+    for chan_idx in chan_offsets:
+        rowmask = rows["channel"] == chan_idx
+        yield chan_idx, {key: val[rowmask] for key, val in rows.items()}
+
+
+def average_uvdist(uvsum, counts):
+    """Average UV distance of all rows on each baseline."""
+
+    return np.divide(
+        uvsum,
+        counts,
+        out=np.full(len(uvsum), np.nan),
+        where=counts > 0,
     )
 
-    return scale
 
+def read_uvdist(uvdist):
+    """Read sums and counts of UV distances of the rows already stored in the DS."""
+
+    counts = uvdist.attrs.get("rows", np.zeros(len(uvdist), dtype=int))
+
+    return np.nan_to_num(uvdist[:]) * counts, counts
+
+
+def write_uvdist(uvdist, uvsum, uvcount):
+    """Store average UV distances given sums and counts of all rows in the DS."""
+
+    uvdist[:] = average_uvdist(uvsum, uvcount)
+    uvdist.attrs["rows"] = uvcount
 
-def process_baseline(ms, times, baseline, datacolumn):
+    return
 
-    i, (ant1, ant2) = baseline
+
+def open_time_ordered(ms, query=None):
+    """Open MS table, sorting rows by time if not already in time order."""
 
     tab = table(ms, ack=False, lockoptions="autonoread")
-    bl_tab = tab.query("(ANTENNA1==$ant1) && (ANTENNA2==$ant2)")
-
-    # Identify missing integrations on this baseline
-    bl_time = bl_tab.getcol("TIME")
-    missing_times = [t for t in times if t not in bl_time]
-
-    # Add back to time column and identify indices of good integrations
-    bl_time = np.sort(np.append(bl_time, missing_times))
-    data_idx = np.argwhere(~np.in1d(bl_time, missing_times)).ravel()
-
-    # Calculate UVrange for each baseline
-    bl_uvw = bl_tab.getcol("UVW")
-    bl_uvdist = np.sqrt(np.sum(np.square(bl_uvw), axis=1))
-
-    data = {
-        "baseline": i,
-        "data_idx": data_idx,
-        "data": bl_tab.getcol(datacolumn),
-        "flags": bl_tab.getcol("FLAG"),
-        "uvdist": np.nanmean(bl_uvdist, axis=0),
-    }
 
+    # Optionally select rows, e.g. by antenna or time range
+    if query is not None:
+        tab = tab.query(query)
+
+    if np.any(np.diff(tab.getcol("TIME")) < 0):
+        logger.debug(f"Rows of {ms} are not time-ordered, sorting by TIME")
+        tab = tab.sort("TIME")
+
+    return tab
+
+
+def get_tile_shape(ms, column):
+    """Get (polarisation, channel, row) tile shape of a column, or None if not tiled."""
+
+    tab = table(ms, ack=False, lockoptions="autonoread")
+    dminfo = tab.getdminfo(column)
     tab.close()
-    bl_tab.close()
 
-    return data
+    if not dminfo["TYPE"].startswith("Tiled"):
+        return None
 
+    # Hypercubes of a TiledShapeStMan column (e.g. one per cell shape) can
+    # differ in tile shape, so use that of the hypercube holding most rows
+    hypercubes = dminfo["SPEC"].get("HYPERCUBES", {})
+    if hypercubes:
+        cube = max(hypercubes.values(), key=lambda cube: cube["CubeShape"][-1])
+        return tuple(int(n) for n in cube["TileShape"])
 
-@click.command()
-@click.option(
-    "-d",
-    "--datacolumn",
-    type=click.Choice(["data", "corrected", "model"]),
-    default="data",
-    help="Selection of DATA, CORRECTED_DATA, or MODEL column.",
-)
-@click.option(
-    "-p",
-    "--phasecentre",
-    type=str,
-    nargs=2,
-    default=None,
-    help="RA and Dec of phasecentre at which to extract DS.",
-)
-@click.option(
-    "-P",
-    "--primary-beam",
-    type=click.Path(),
-    default=None,
-    help="Path to primary beam image with which to correct flux scale. Must also provide phasecentre.",
-)
-@click.option(
-    "-F",
-    "--noflag",
-    is_flag=True,
-    default=False,
-    help="Remove flagging mask.",
-)
-@click.option(
-    "-B",
-    "--baseline-average",
-    is_flag=True,
-    default=True,
-    help="Disable averaging over baseline axis.",
-)
-@click.option(
-    "-u",
-    "--minuvdist",
-    type=float,
-    default=0,
-    help="Minimum UV distance in meters to retain if averaging over baseline axis.",
-)
-@click.option(
-    "-v",
-    "--verbose",
-    is_flag=True,
-    default=False,
-    help="Enable verbose logging.",
-)
-@click.argument("ms")
-@click.argument("outfile")
-def main(
-    datacolumn,
-    phasecentre,
-    primary_beam,
-    noflag,
-    baseline_average,
-    minuvdist,
-    verbose,
-    ms,
-    outfile,
-):
+    return tuple(int(n) for n in dminfo["SPEC"]["DEFAULTTILESHAPE"])
 
-    setupLogger(verbose=verbose)
 
-    columns = {
-        "data": "DATA",
-        "corrected": "CORRECTED_DATA",
-        "model": "MODEL_DATA",
-    }
-    datacolumn = columns[datacolumn]
+def get_tile_rows(ms, columns):
+    """Get smallest row count spanning whole tiles of all tiled columns."""
 
-    # Combine multiple spectral windows (e.g. VLA)
-    # This also appears to fix an MS corrupted by model insertion
-    # which has otherwise been very difficult to debug
-    ms = combine_spws(ms)
+    tile_rows = 1
+    for column in columns:
+        tile_shape = get_tile_shape(ms, column)
+        logger.debug(f"{column} column has tile shape {tile_shape}")
 
-    # Check that selected column exists in MS
-    if not validate_datacolumn(ms, datacolumn):
-        logger.error(f"{datacolumn} column does not exist in {ms}")
-        exit(1)
+        if tile_shape is not None:
+            tile_rows = np.lcm(tile_rows, tile_shape[-1])
 
-    # Optionally rotate phasecentre to new coordinates
-    pb_scale = 1
-    if phasecentre is not None:
-        ra, dec = parse_coordinates(phasecentre)
-        ms = rotate_phasecentre(ms, ra, dec)
-        pb_scale = get_pb_correction(primary_beam, ra, dec)
+    return int(tile_rows)
 
-    # Construct header with observation properties
-    header = get_header_properties(ms, datacolumn, pb_scale)
 
-    # Optionally average over baselines
-    if baseline_average:
-        logger.debug(f"Averaging over baseline axis with uvdist > {minuvdist}m")
-        os.system(f"_dstools-avg-baselines -u {minuvdist} {ms} 1>/dev/null")
-        ms = ms.replace(".ms", ".dstools-temp.baseavg.ms")
-
-    # Calculate final dimensions of DS
-    times, freqs, antennas, nbaselines = get_data_dimensions(ms)
-    data_shape = (nbaselines, len(times), len(freqs), 4)
-
-    # Initialise output arrays
-    waterfall = np.full(data_shape, np.nan, dtype=complex)
-    flags = np.full(data_shape, np.nan, dtype=bool)
-    uvdist = np.full(nbaselines, np.nan)
-
-    # Construct 4D data and flag cubes on each baseline separately
-    # to verify indices of missing data (e.g. due to correlator dropouts)
-    with ProcessPoolExecutor(max_workers=15) as executor:
-        processes = [
-            executor.submit(
-                process_baseline,
-                ms,
-                np.copy(times),
-                baseline,
-                datacolumn,
-            )
-            for baseline in enumerate(it.combinations(antennas, 2))
-        ]
-        wait(processes)
+def get_tile_channels(ms, columns):
+    """Get smallest channel count spanning whole tiles of all tiled columns."""
 
-    # Insert data into 4D data / flag cubes
-    results = [p.result() for p in processes]
-    for baseline in results:
-        baseline_idx, data_idx = baseline["baseline"], baseline["data_idx"]
-        waterfall[baseline_idx, data_idx] = baseline["data"]
-        flags[baseline_idx, data_idx] = baseline["flags"]
-        uvdist[baseline_idx] = baseline["uvdist"]
+    tile_channels = 1
+    for column in columns:
+        tile_shape = get_tile_shape(ms, column)
+        if tile_shape is not None:
+            tile_channels = np.lcm(tile_channels, tile_shape[1])
 
-    # Apply flags
-    if not noflag:
-        waterfall[flags] = np.nan
-
-    # Apply primary beam correction
-    waterfall /= header["pb_scale"]
-
-    # Write all data to file
-    with h5py.File(outfile, "w", track_order=True) as f:
-        for attr in header:
-            f.attrs[attr] = header[attr]
-        f.create_dataset("time", data=times)
-        f.create_dataset("frequency", data=freqs)
-        f.create_dataset("uvdist", data=uvdist)
-        f.create_dataset("flux", data=waterfall)
-
-    # Clean up intermediate files
-    ms_dir = Path(ms).parent
-    os.system(f"rm -r {ms_dir}/*dstools-temp*.ms 2>/dev/null")
-    os.system("rm *.pre *.last 2>/dev/null")
+    return int(tile_channels)
+
+
+def get_channel_shards(nchan, nshards, start=0, tile_channels=1):
+    """Split channels into contiguous shards with boundaries on tile edges."""
+
+    # Group tiles overlapping the channels from start into shards,
+    # so that each tile is read by only one shard
+    tile_starts = np.arange(start - start % tile_channels, start + nchan, tile_channels)
+    groups = [group for group in np.array_split(tile_starts, nshards) if len(group)]
+
+    # Return first and last channel of each shard relative to start
+    firsts = [max(int(group[0]) - start, 0) for group in groups]
+    lasts = [first - 1 for first in firsts[1:]] + [nchan - 1]
+
+    return list(zip(firsts, lasts))
+
+
+def get_available_memory():
+    """Get memory in bytes available to new processes without swapping."""
+
+    # MemAvailable includes reclaimable page cache, which fills up while reading an MS
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def get_memory_budget(max_memory=None, jobs=1):
+    """Get memory budget in GB, defaulting to a share of half of the available memory."""
+
+    if max_memory is not None:
+        return max_memory
+
+    return 0.5 * get_available_memory() / jobs / 1024**3
+
+
+def get_row_bytes(nchan, dtype, ntargets=1):
+    """Estimate peak memory in bytes used by each row read from the MS."""
+
+    # Each visibility is read as complex64 data and a bool flag, copied when
+    # discarding autocorrelations and flagging, rotated to each target, then
+    # held in the output cubes of each target
+    itemsize = np.dtype(dtype).itemsize
+
+    return nchan * 4 * (2 * 8 + 3 * 1 + ntargets * (8 + itemsize))
+
+
+def get_min_shards(max_memory, nchan, row_times, workers, dtype, ntargets=1):
+    """Get number of channel shards needed to read an integration per worker within budget."""
+
+    _, integration_rows = np.unique(row_times, return_counts=True)
+    integration_bytes = integration_rows.max() * get_row_bytes(nchan, dtype, ntargets)
+
+    # Shards of an integration are read concurrently by separate workers, so
+    # sharding allows fewer integrations to be held at once
+    budget = max_memory * 1024**3
+    if integration_bytes > budget:
+        logger.warning(
+            f"Reading a single integration needs {integration_bytes / 1024**3:.2f} GB,"
+            f" exceeding the memory budget of {max_memory:.2f} GB"
+        )
+
+    nshards = int(-(-integration_bytes * workers // budget))
+
+    return min(max(nshards, 1), nchan)
+
+
+def get_block_workers(workers, nshards, min_shards):
+    """Get number of blocks read at once, with workers shared between shards of each block.
+
+    If channel tiles allow fewer shards than needed to fit an integration per
+    worker within the memory budget, fewer blocks are read at once instead.
+    """
+
+    block_workers = max(workers // max(nshards, min_shards), 1)
+    if nshards < min_shards:
+        logger.warning(
+            f"Channel tiles allow {nshards} of the {min_shards} channel shards needed"
+            f" to fit the memory budget, reading {block_workers} blocks at once"
+        )
+
+    return block_workers
+
+
+def get_rows_per_block(
+    max_memory,
+    nchan,
+    nrows,
+    workers,
+    dtype,
+    ntargets=1,
+    tile_rows=1,
+):
+    """Calculate number of rows each worker can process within memory budget in GB."""
+
+    # Share all rows evenly between workers, rounded up to whole tiles
+    even_rows = -(-nrows // workers)
+    even_rows = -(-even_rows // tile_rows) * tile_rows
+    if max_memory is None:
+        return even_rows
+
+    row_bytes = get_row_bytes(nchan, dtype, ntargets)
+    rows_per_block = int(max_memory * 1024**3 // (workers * row_bytes))
+
+    # Round down to whole tiles, reading at least one tile, while
+    # keeping blocks small enough to give every worker a share
+    return min(max(rows_per_block // tile_rows, 1) * tile_rows, even_rows)
+
+
+def get_row_blocks(row_times, times, rows_per_block, tile_rows=1, time_bins=None):
+    """Split time-ordered rows into blocks of whole integrations.
+
+    If integrations are averaged into bins, blocks only split between bins.
+    """
+
+    # Row indices at which each new integration starts, terminated by row count
+    int_starts = np.append(np.flatnonzero(np.diff(row_times)) + 1, len(row_times))
+
+    if time_bins is not None:
+        bin_starts = np.append(True, np.diff(time_bins) != 0)
+        time_idx = np.searchsorted(times, row_times[int_starts[:-1]])
+        keep = bin_starts[np.minimum(time_idx, len(times) - 1)]
+        int_starts = np.append(int_starts[:-1][keep], int_starts[-1])
+
+    # Skip rows preceding the time axis, e.g. integrations already stored
+    # in a DS that is being appended to
+    blocks = []
+    startrow = np.searchsorted(row_times, times[0], side="left")
+    while startrow < len(row_times):
+        # Extend block to the last integration boundary within budget,
+        # or to the next boundary if one integration alone exceeds budget.
+        # The budget is cut back to a tile boundary where possible so that
+        # tiles are not read again by neighbouring blocks
+        budget_end = startrow + rows_per_block
+        if budget_end - budget_end % tile_rows > startrow:
+            budget_end -= budget_end % tile_rows
+
+        next_idx = np.searchsorted(int_starts, startrow, side="right")
+        budget_idx = np.searchsorted(int_starts, budget_end, side="right") - 1
+        endrow = int_starts[max(next_idx, budget_idx)]
+
+        # Store range of time axis covered by block
+        tmin = np.searchsorted(times, row_times[startrow], side="left")
+        tmax = np.searchsorted(times, row_times[endrow - 1], side="right")
+
+        blocks.append((startrow, endrow - startrow, tmin, tmax))
+        startrow = endrow
+
+    return blocks
+
+
+def estimate_resources(
+    ms,
+    data_shape,
+    ntargets,
+    windows,
+    nchan,
+    workers,
+    dtype,
+    noflag,
+    combine,
+    cube_channels=None,
+):
+    """Predict peak memory, temporary disk usage, and output size in bytes.
+
+    Shared cubes hold cube_channels channels if these are averaged when written.
+    """
+
+    nbaselines, ntimes, nchans, npol = data_shape
+    cube_channels = cube_channels or nchans
+    itemsize = np.dtype(dtype).itemsize
+    flag_bytes = 0 if noflag else 1
+
+    # Shared cubes hold the longest window of integrations of every target
+    window_ntime = get_window_ntime(windows)
+    cube_bytes = nbaselines * window_ntime * cube_channels * npol
+    cube_bytes *= ntargets * itemsize + flag_bytes
+
+    # Each concurrent block holds complex64 data and bool flags, copied when
+    # discarding autocorrelations, then rotated to each target
+    block_rows = max(
+        sum(sorted(nrow for _, nrow, _, _ in window)[-workers:]) for window in windows
+    )
+    block_bytes = block_rows * nchan * npol * (2 * 8 + 3 * 1 + ntargets * 8)
+
+    # Spectral windows of unequal size are combined into a copy of the MS
+    ms_bytes = sum(size for _, size, _ in get_path_identity(ms))
+    temp_bytes = ms_bytes if combine else 0
+
+    # Output size before compression
+    flux_bytes = nbaselines * ntimes * nchans * npol * itemsize
+    packed_flag_bytes = nbaselines * ntimes * -(-nchans * npol // 8) * flag_bytes
+    output_bytes = ntargets * (flux_bytes + packed_flag_bytes)
+
+    return {
+        "memory": cube_bytes + block_bytes,
+        "temp_disk": temp_bytes,
+        "output": output_bytes,
+    }
+
+
+def get_recommended_workers(max_memory, nchan, row_times, dtype, ntargets=1):
+    """Recommend worker and channel shard counts fitting within memory budget in GB."""
+
+    _, integration_rows = np.unique(row_times, return_counts=True)
+    integration_bytes = integration_rows.max() * get_row_bytes(nchan, dtype, ntargets)
+    budget = max_memory * 1024**3
+
+    # Each worker holds at least one integration at once, as when sizing blocks,
+    # or a shard of its channels if split into (at most single channel) shards
+    max_workers = int(budget * nchan // integration_bytes)
+    workers = max(min(os.cpu_count(), max_workers), 1)
+
+    # Channels are split between workers if an integration per worker does
+    # not fit, or if there are fewer integrations than workers
+    nshards = max(
+        -(-integration_bytes * workers // budget),
+        -(-workers // len(integration_rows)),
+    )
+
+    return workers, int(min(max(nshards, 1), nchan))
+
+
+def log_dry_run(
+    header,
+    estimate,
+    data_shape,
+    dtype,
+    chunk_shape,
+    max_memory,
+    nchan,
+    row_times,
+    ntargets=1,
+):
+    """Log predicted resource usage and recommended settings for this machine."""
+
+    _, ntimes, _, npol = data_shape
+    itemsize = np.dtype(dtype).itemsize
+    gb = 1024**3
+
+    logger.info(
+        f"DS of {header['baselines']} baselines x {header['integrations']} integrations"
+        f" x {header['channels']} channels x {header['polarisations']} polarisations"
+        f" ({header['correlations']} correlations), stored with shape {data_shape}"
+    )
+    logger.info(f"Predicted peak memory: {estimate['memory'] / gb:.2f} GB")
+    logger.info(f"Predicted temporary disk usage: {estimate['temp_disk'] / gb:.2f} GB")
+    logger.info(
+        f"Predicted output size before compression: {estimate['output'] / gb:.2f} GB"
+    )
+
+    # Recommend a memory budget if extraction would not fit in available memory
+    available = get_available_memory()
+    if estimate["memory"] > 0.8 * available:
+        logger.warning(
+            f"Predicted memory exceeds {available / gb:.1f} GB available, "
+            f"set a smaller budget with -M {0.5 * available / gb:.1f}"
+        )
+
+    # Recommend workers reading blocks within the memory budget, which
+    # defaults to half of the available memory
+    workers, nshards = get_recommended_workers(
+        max_memory,
+        nchan,
+        row_times,
+        dtype,
+        ntargets,
+    )
+    shards = f" with --freq-shards {nshards}" if nshards > 1 else ""
+    logger.info(
+        f"Recommended workers within {max_memory:.2f} GB budget: {workers} (-w){shards}"
+    )
+
+    # Aim for chunks of around 1 MB, which keeps both full time-series
+    # and single-integration reads efficient
+    chunk = get_chunk_shape(data_shape, *chunk_shape)
+    chunk_bytes = np.prod(chunk) * itemsize
+    chunk_channels = chunk[2]
+    chunk_integrations = 2 ** int(
+        np.log2(max(1024**2 / (chunk_channels * npol * itemsize), 1))
+    )
+    chunk_integrations = min(chunk_integrations, ntimes)
+    logger.info(
+        f"Chunk shape {chunk} of {chunk_bytes / 1024**2:.2f} MB, recommended "
+        f"--chunk-shape {chunk_integrations} {chunk_channels}"
+    )
+
+    return
+
+
+def get_chunk_shape(data_shape, chunk_integrations, chunk_channels):
+    """Calculate time-major HDF5 chunk shape spanning one baseline and all polarisations."""
+
+    _, ntimes, nchan, npol = data_shape
+
+    return (
+        1,
+        max(min(ntimes, chunk_integrations), 1),
+        max(min(nchan, chunk_channels), 1),
+        npol,
+    )
+
+
+def get_flag_chunk_shape(chunk_shape):
+    """Calculate chunk shape of bit-packed flags matching chunks of flux dataset."""
+
+    _, chunk_integrations, chunk_channels, npol = chunk_shape
+
+    return (1, chunk_integrations, max(chunk_channels * npol // 8, 1))
+
+
+def pack_flags(flags):
+    """Bit-pack flags along the combined channel / polarisation axis."""
+
+    nbaselines, ntimes, _, _ = flags.shape
+
+    return np.packbits(flags.reshape(nbaselines, ntimes, -1), axis=-1)
+
+
+def create_datasets(
+    f,
+    header,
+    times,
+    freqs,
+    data_shape,
+    dtype,
+    chunk_shape,
+    compression,
+    noflag,
+    unflagged=False,
+):
+    """Write header and axes of a DS and create its uvdist, flux, and flag datasets.
+
+    Data averaged with flags applied is optionally also stored unflagged.
+    """
+
+    nbaselines, ntimes, nchan, npol = data_shape
+
+    # Time axis is left extendable so that later epochs can be appended
+    for attr in header:
+        f.attrs[attr] = header[attr]
+
+    # Stored axes are shorter than those of the MS if averaged
+    f.attrs["integrations"] = ntimes
+    f.attrs["channels"] = nchan
+    f.attrs["correlations"] = header["baselines"] * ntimes * nchan * npol
+
+    # No integrations are complete until all have been written
+    f.attrs["last_integration"] = -np.inf
+
+    f.create_dataset("time", data=times, maxshape=(None,))
+    f.create_dataset("frequency", data=freqs)
+    uvdist = f.create_dataset("uvdist", shape=(nbaselines,), dtype=float)
+    flux_datasets = ["flux", "flux_noflag"] if unflagged else ["flux"]
+    flux, *flux_noflag = [
+        f.create_dataset(
+            name,
+            shape=data_shape,
+            maxshape=(nbaselines, None, nchan, npol),
+            dtype=dtype,
+            chunks=get_chunk_shape(data_shape, *chunk_shape),
+            compression=compression,
+            shuffle=compression is not None,
+            fillvalue=np.nan + 1j * np.nan,
+        )
+        for name in flux_datasets
+    ]
+
+    # Store flags bit-packed along channel / polarisation axis,
+    # with missing integrations left flagged
+    flags = None
+    if not noflag:
+        flags = f.create_dataset(
+            "flags",
+            shape=(nbaselines, ntimes, -(-nchan * npol // 8)),
+            maxshape=(nbaselines, None, -(-nchan * npol // 8)),
+            dtype=np.uint8,
+            chunks=get_flag_chunk_shape(flux.chunks),
+            compression=compression,
+            fillvalue=255,
+        )
+
+    return uvdist, flux, flags, next(iter(flux_noflag), None)
+
+
+def read_append_times(
+    outfile, header, freqs, data_shape, dtype, noflag, unflagged=False
+):
+    """Check new integrations can be appended to an existing DS and return its last integration.
+
+    This is the last integration of the MS completely written to the DS, which
+    follows the time axis if averaged, or precedes it if an append failed.
+    """
+
+    nbaselines, _, nchan, npol = data_shape
+
+    # Array size may differ between epochs once averaged over baselines
+    ignored = ["integrations", "correlations"]
+    if nbaselines == 1:
+        ignored += ["antennas", "baselines"]
+
+    with h5py.File(outfile, "r") as f:
+        # DS extracted without averaging do not record averaging factors
+        no_averaging = {"tavg": 1, "favg": 1}
+        attrs = no_averaging | dict(f.attrs)
+        expected = no_averaging | header
+        mismatched = [
+            attr
+            for attr in expected
+            if attr not in ignored and attrs.get(attr) != expected[attr]
+        ]
+        if mismatched:
+            raise ValueError(
+                f"Cannot append to {outfile} as {', '.join(mismatched)} differ."
+            )
+
+        existing_freqs = f["frequency"][:]
+        if existing_freqs.shape != freqs.shape or not np.allclose(
+            existing_freqs, freqs
+        ):
+            raise ValueError(f"Cannot append to {outfile} as frequencies differ.")
+
+        flux = f["flux"]
+        if flux.shape[0] != nbaselines or flux.dtype != dtype:
+            raise ValueError(
+                f"Cannot append to {outfile} as baseline averaging or precision differ."
+            )
+        if flux.maxshape[1] is not None:
+            raise ValueError(f"Cannot append to {outfile} as time axis is fixed size.")
+        if ("flags" in f) == noflag or ("flux_noflag" in f) != unflagged:
+            raise ValueError(f"Cannot append to {outfile} as flag storage differs.")
+
+        return attrs.get("last_integration", f["time"][-1])
+
+
+def get_append_times(
+    outfiles, headers, times, freqs, data_shape, dtype, noflag, unflagged=False
+):
+    """Select integrations following those already stored in the DS of each target."""
+
+    if not all(os.path.exists(path) for path in outfiles):
+        logger.error("Cannot append as DS of some targets do not exist")
+        exit(1)
+
+    last_times = [
+        read_append_times(path, header, freqs, data_shape, dtype, noflag, unflagged)
+        for path, header in zip(outfiles, headers)
+    ]
+    if len(np.unique(last_times)) > 1:
+        logger.error("Cannot append as DS of targets end at different times")
+        exit(1)
+
+    return times[times > last_times[0]]
+
+
+def get_append_offset(f):
+    """Get position along time axis following the integrations completed in a DS."""
+
+    last_integration = f.attrs.get("last_integration", f["time"][-1])
+
+    return int(np.searchsorted(f["time"][:], last_integration, side="right"))
+
+
+def extend_datasets(f, times):
+    """Extend time axis of an existing DS with new integrations.
+
+    Integrations left by a failed append are replaced by the new integrations.
+    """
+
+    offset = get_append_offset(f)
+    ntimes = offset + len(times)
+
+    f["time"].resize(ntimes, axis=0)
+    f["time"][offset:] = times
+
+    # New integrations are filled as missing until written
+    flux = f["flux"]
+    flux.resize(ntimes, axis=1)
+
+    flags = f.get("flags")
+    if flags is not None:
+        flags.resize(ntimes, axis=1)
+
+    flux_noflag = f.get("flux_noflag")
+    if flux_noflag is not None:
+        flux_noflag.resize(ntimes, axis=1)
+
+    _, _, nchan, npol = flux.shape
+    f.attrs["integrations"] = ntimes
+    f.attrs["correlations"] = f.attrs["baselines"] * ntimes * nchan * npol
+
+    return f["uvdist"], flux, flags, flux_noflag
+
+
+def open_datasets(
+    stack,
+    outfiles,
+    headers,
+    times,
+    freqs,
+    data_shape,
+    dtype,
+    chunk_shape,
+    compression,
+    noflag,
+    appending,
+    checkpoint,
+    unflagged=False,
+):
+    """Open DS of each target for writing, returning time offset and datasets to write."""
+
+    # Reopen partially written DS of an interrupted run
+    if checkpoint.started:
+        files = [stack.enter_context(h5py.File(path, "r+")) for path in outfiles]
+        datasets = [
+            (f["uvdist"], f["flux"], f.get("flags"), f.get("flux_noflag"))
+            for f in files
+        ]
+        return checkpoint.offset, datasets
+
+    if appending:
+        files = [stack.enter_context(h5py.File(path, "a")) for path in outfiles]
+        offset = get_append_offset(files[0])
+        return offset, [extend_datasets(f, times) for f in files]
+
+    datasets = [
+        create_datasets(
+            stack.enter_context(h5py.File(path, "w", track_order=True)),
+            header,
+            times,
+            freqs,
+            data_shape,
+            dtype,
+            chunk_shape,
+            compression,
+            noflag,
+            unflagged,
+        )
+        for path, header in zip(outfiles, headers)
+    ]
+
+    return 0, datasets
+
+
+def get_scratch_dir(scratch_dir, ms):
+    """Get directory in which to create scratch directories, by default that of the MS.
+
+    Falls back to the system temporary directory if the MS is in a read-only archive.
+    """
+
+    if scratch_dir is not None:
+        return scratch_dir
+
+    ms_dir = Path(ms).absolute().parent
+    if os.access(ms_dir, os.W_OK):
+        return ms_dir
+
+    return tempfile.gettempdir()
+
+
+def open_scratch(scratch_dir, ms, options, resume=False, temporary=True):
+    """Create scratch directory for temporary files of a run, if it has any.
+
+    Resumable runs use a directory identified by the MS and options, which is
+    kept along with its checkpoint if the run fails.
+    """
+
+    if resume:
+        return resumable_directory(scratch_dir, get_cache_key(ms, options))
+
+    if not temporary:
+        return nullcontext()
+
+    return tempfile.TemporaryDirectory(prefix="dstools-", dir=scratch_dir)
+
+
+def create_shared_array(shape, dtype, shared=True):
+    """Allocate an array, backed by shared memory if shared between processes."""
+
+    if not shared:
+        return None, np.empty(shape, dtype=dtype)
+
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shm = SharedMemory(create=True, size=max(size, 1))
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def attach_shared_array(array, shape, dtype):
+    """Attach to an array shared by name in shared memory, or directly between threads."""
+
+    if not isinstance(array, str):
+        return None, array
+
+    shm = SharedMemory(name=array)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def get_window_ntime(windows):
+    """Get the number of integrations spanned by the longest window of blocks."""
+
+    return max(window[-1][3] - window[0][2] for window in windows)
+
+
+def fit_shared_memory(windows, integration_bytes):
+    """Split windows of blocks until shared output cubes fit in free shared memory.
+
+    Shared memory is often limited far below available memory (e.g. to 64 MB
+    in containers), and writing beyond the limit crashes with SIGBUS.
+    """
+
+    if not os.path.exists("/dev/shm"):
+        return windows
+
+    free = shutil.disk_usage("/dev/shm").free
+    max_window_size = max(len(window) for window in windows)
+    window_size = max_window_size
+    while window_size > 1 and get_window_ntime(windows) * integration_bytes > free:
+        window_size = -(-window_size // 2)
+        windows = [
+            window[i : i + window_size]
+            for window in windows
+            for i in range(0, len(window), window_size)
+        ]
+
+    if get_window_ntime(windows) * integration_bytes > free:
+        logger.error(
+            f"Output cubes of a single block exceed {free / 1024**2:.1f} MB of free"
+            " shared memory, set a smaller budget with -M or use --backend thread"
+        )
+        exit(1)
+
+    if window_size < max_window_size:
+        logger.warning(
+            f"Reading {window_size} rather than {max_window_size} blocks at once"
+            f" to fit within {free / 1024**2:.1f} MB of free shared memory"
+        )
+
+    return windows
+
+
+def scatter_rows(waterfall, flagcube, rows, toffset, pb_scales):
+    """Insert a block of rows into the output data and flag cubes."""
+
+    # Apply primary beam correction of each target and insert
+    # at time / channel offset of cube
+    pb_scales = pb_scales[:, np.newaxis, np.newaxis, np.newaxis]
+    for chan_idx, spw_rows in split_spectral_windows(rows):
+        baseline_idx = spw_rows["baseline"]
+        time_idx = spw_rows["time"] - toffset
+        chans = slice(chan_idx, chan_idx + spw_rows["data"].shape[2])
+
+        data = np.moveaxis(spw_rows["data"], 1, 0)
+        waterfall[:, baseline_idx, time_idx, chans] = data / pb_scales
+        if flagcube is not None:
+            flagcube[baseline_idx, time_idx, chans] = spw_rows["flags"]
+
+    return
+
+
+@dataclass
+class BinAverager:
+    """Averages integrations and channels of the output cubes into bins as they are written.
+
+    Averages follow the flux-conserving rules of rebin2D, with flagged and
+    missing data counted as zero and empty bins left as NaN. Bins of
+    integrations restart at each scan, so that scans are never averaged together.
+    """
+
+    tavg: int = 1
+    favg: int = 1
+    time_bins: Optional[np.ndarray] = None
+    freq_comp: Optional[np.ndarray] = None
+
+    @property
+    def averaging(self):
+        return self.tavg > 1 or self.favg > 1
+
+    @property
+    def attrs(self):
+        """Header attributes recording averaging, needed to append to the DS."""
+
+        if not self.averaging:
+            return {}
+
+        return {"tavg": self.tavg, "favg": self.favg}
+
+    def bin_frequencies(self, freqs):
+        """Set up channel compressor and return the averaged frequency axis."""
+
+        if self.favg == 1:
+            return freqs
+
+        nchan = len(freqs)
+        if self.favg > nchan:
+            raise ValueError(f"Cannot average {nchan} channels by {self.favg}.")
+
+        self.freq_comp = rebin(nchan, nchan // self.favg, axis=1)
+
+        return freqs @ self.freq_comp
+
+    def bin_times(self, times):
+        """Assign integrations to bins and return the averaged time axis."""
+
+        if not self.averaging:
+            return times
+
+        # Scans start after gaps longer than the typical integration interval
+        dts = np.diff(times)
+        scan_starts = np.append(True, dts > 1.5 * np.median(dts) if len(dts) else [])
+        scan_idx = np.cumsum(scan_starts) - 1
+        position = np.arange(len(times)) - np.flatnonzero(scan_starts)[scan_idx]
+
+        self.time_bins = np.cumsum(position % self.tavg == 0) - 1
+
+        counts = np.bincount(self.time_bins)
+
+        return np.bincount(self.time_bins, weights=times) / counts
+
+    def _average(self, cube, tslice):
+        """Average the time / frequency axes of a cube spanning whole bins of integrations."""
+
+        # Sum over the integrations of each bin, then divide by bin size
+        bins = self.time_bins[tslice]
+        starts = np.flatnonzero(np.diff(bins, prepend=bins[0] - 1))
+        counts = np.diff(np.append(starts, len(bins))).astype(cube.real.dtype)
+        cube = np.add.reduceat(cube, starts, axis=-3)
+        cube /= counts[:, np.newaxis, np.newaxis]
+
+        if self.freq_comp is not None:
+            freq_comp = self.freq_comp.astype(cube.real.dtype)
+            cube = np.moveaxis(np.moveaxis(cube, -2, -1) @ freq_comp, -1, -2)
+
+        return cube
+
+    def average(self, waterfall, flagcube, tslice, nflagged=None):
+        """Average cubes of whole bins of integrations, returning the range of bins they span.
+
+        Flags are applied to the first nflagged targets, or all targets if not given.
+        """
+
+        if not self.averaging:
+            return waterfall, flagcube, tslice
+
+        # Flagged and missing data are excluded from averages as zeros
+        data = waterfall.copy()
+        if flagcube is not None:
+            data[:nflagged][:, flagcube] = np.nan
+        data[np.isnan(data)] = 0
+        data = self._average(data, tslice)
+        data[data == 0] = np.nan
+
+        # Bins are flagged if none of their data are unflagged
+        if flagcube is not None:
+            flagcube = self._average((~flagcube).astype(np.float32), tslice) == 0
+
+        bins = self.time_bins[tslice]
+        tslice = slice(int(bins[0]), int(bins[-1]) + 1)
+
+        return data.astype(waterfall.dtype, copy=False), flagcube, tslice
+
+
+def write_integrations(
+    fluxes,
+    flags,
+    waterfall,
+    flagcube,
+    cube_slice,
+    tslice,
+    offset=0,
+    averager=None,
+):
+    """Write a range of integrations of the output cubes to each target dataset.
+
+    Integrations are optionally averaged into bins, then written from offset
+    along the time axis of the datasets. Any datasets following those of
+    each target with flags hold unflagged data.
+    """
+
+    averager = averager or BinAverager()
+    waterfall, flagcube, tslice = averager.average(
+        waterfall[:, :, cube_slice],
+        None if flagcube is None else flagcube[:, cube_slice],
+        tslice,
+        len(flags),
+    )
+    tslice = slice(offset + tslice.start, offset + tslice.stop)
+
+    bytes_written = 0
+    for flux, target_waterfall in zip(fluxes, waterfall):
+        flux[:, tslice] = target_waterfall
+        bytes_written += target_waterfall.nbytes
+
+    if flagcube is not None:
+        packed_flags = pack_flags(flagcube)
+        for target_flags in flags:
+            target_flags[:, tslice] = packed_flags
+            bytes_written += packed_flags.nbytes
+
+    return bytes_written
+
+
+def init_worker(ms, reader, cubes, cube_shape, dtype, lock):
+    """Open MS and attach to shared output cubes once for each worker.
+
+    Cubes are given by shared memory name for processes, or as arrays for threads.
+    """
+
+    ntargets, *flag_shape = cube_shape
+
+    data_cube, flag_cube = cubes
+
+    # casacore is not thread-safe, so threads must take turns using the MS,
+    # including while opening and sorting it
+    _worker.lock = lock if lock is not None else nullcontext()
+    with _worker.lock:
+        _worker.tab = open_time_ordered(ms, reader.query)
+    _worker.reader = reader
+
+    _worker.data_shm, _worker.waterfall = attach_shared_array(
+        data_cube,
+        cube_shape,
+        dtype,
+    )
+
+    _worker.flagcube = None
+    if flag_cube is not None:
+        _worker.flag_shm, _worker.flagcube = attach_shared_array(
+            flag_cube,
+            flag_shape,
+            bool,
+        )
+
+    return
+
+
+def process_block(startrow, nrow, toffset, pb_scales, shard=None):
+    """Read a block of rows and write it directly into the shared output cubes.
+
+    If given a shard of channels, only that frequency slab of the cubes is filled.
+    """
+
+    report = TimingReport()
+
+    reader = _worker.reader
+    if shard is not None:
+        reader = reader.select_channels(*shard)
+
+    rows = reader.process_rows(_worker.tab, startrow, nrow, report, _worker.lock)
+
+    with report.time("scatter") as stage:
+        scatter_rows(_worker.waterfall, _worker.flagcube, rows, toffset, pb_scales)
+        stage.rows += len(rows["time"])
+
+    # Return per-baseline UV distance sums to be averaged over all blocks,
+    # counting rows only in the first shard of channels
+    nbaselines = _worker.waterfall.shape[1]
+    if shard is not None and shard[0] > 0:
+        return np.zeros(nbaselines), np.zeros(nbaselines, dtype=int), report
+
+    return *sum_uvdist(rows, nbaselines), report
+
+
+def sum_uvdist(rows, nbaselines):
+    """Sum UV distance and count rows of each baseline."""
+
+    uvsum = np.bincount(rows["baseline"], weights=rows["uvdist"], minlength=nbaselines)
+    uvcount = np.bincount(rows["baseline"], minlength=nbaselines)
+
+    return uvsum, uvcount
+
+
+def work_queue(queue):
+    """Claim and run row block tasks from a queue until none are left to claim."""
+
+    plan = queue.load_plan()
+    if plan is None:
+        return 0
+
+    # Only open the MS once a task is claimed
+    task = queue.claim_next(len(plan["blocks"]))
+    if task is None:
+        return 0
+
+    reader = plan["reader"]
+    ntargets, nbaselines, nchan, npol = plan["cube_shape"]
+    tab = open_time_ordered(plan["ms"], reader.query)
+
+    ntasks = 0
+    while task is not None:
+        startrow, nrow, tmin, tmax = plan["blocks"][task]
+
+        report = TimingReport()
+        rows = reader.process_rows(tab, startrow, nrow, report)
+
+        # Scatter rows into cubes spanning only the integrations of this block
+        shape = (ntargets, nbaselines, tmax - tmin, nchan, npol)
+        waterfall = np.full(shape, np.nan, dtype=plan["dtype"])
+        flagcube = np.ones(shape[1:], dtype=bool) if plan["flags"] else None
+        with report.time("scatter") as stage:
+            scatter_rows(waterfall, flagcube, rows, tmin, plan["pb_scales"])
+            stage.rows += len(rows["time"])
+
+        uvsum, uvcount = sum_uvdist(rows, nbaselines)
+        queue.store_result(task, (waterfall, flagcube, uvsum, uvcount, report))
+
+        ntasks += 1
+        task = queue.claim_next(len(plan["blocks"]))
+
+    tab.close()
+
+    return ntasks
+
+
+def run_queue_worker(queue, workers):
+    """Run tasks from a queue in parallel processes until none are left to claim."""
+
+    if queue.path is None:
+        logger.error("Provide the queue of an extraction to work on with --queue")
+        exit(1)
+
+    logger.info(f"Running tasks from {queue.path} with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        ntasks = sum(executor.map(work_queue, [queue] * workers))
+
+    logger.info(f"Completed {ntasks} tasks from {queue.path}")
+
+    return
+
+
+def extract_queue(
+    fluxes,
+    flags,
+    ms,
+    reader,
+    blocks,
+    pb_scales,
+    workers,
+    queue,
+    offset=0,
+    report=None,
+    averager=None,
+    checkpoint=None,
+):
+    """Share row blocks with workers on other nodes through a queue, merging results into the DS.
+
+    The coordinating process also runs tasks with its own workers, and runs any
+    remaining tasks (e.g. of failed workers) once they finish.
+    """
+
+    report = report if report is not None else TimingReport()
+
+    # Workers fill cubes of all channels, which may be averaged when written
+    nbaselines, _, _, npol = fluxes[0].shape
+    nchan = len(reader.freqs)
+    queue.create(
+        {
+            "ms": os.path.abspath(ms),
+            "reader": reader,
+            "blocks": blocks,
+            "pb_scales": pb_scales,
+            "cube_shape": (len(fluxes), nbaselines, nchan, npol),
+            "dtype": fluxes[0].dtype,
+            "flags": bool(flags),
+        }
+    )
+
+    # UV distance sums start from those of rows already stored in the DS
+    checkpoint = checkpoint or Checkpoint()
+    uvsum = np.zeros(nbaselines) + np.array(checkpoint.uvsum or 0)
+    uvcount = np.zeros(nbaselines, dtype=int) + np.array(checkpoint.uvcount or 0)
+    pending = set(range(len(blocks)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        local = []
+        while pending:
+            # Restart local workers once finished to pick up reclaimable tasks
+            if all(future.done() for future in local):
+                for future in local:
+                    future.result()
+                local = [executor.submit(work_queue, queue) for _ in range(workers)]
+
+            ready = queue.ready(sorted(pending))
+            if not ready:
+                time.sleep(queue.poll)
+
+            # Merge results of each task into the DS as they arrive
+            for task in ready:
+                waterfall, flagcube, block_uvsum, block_uvcount, block_report = (
+                    queue.pop_result(task)
+                )
+                uvsum += block_uvsum
+                uvcount += block_uvcount
+                report.merge(block_report)
+
+                _, _, tmin, tmax = blocks[task]
+                with report.time("write") as stage:
+                    stage.bytes_written += write_integrations(
+                        fluxes,
+                        flags,
+                        waterfall,
+                        flagcube,
+                        slice(None),
+                        slice(tmin, tmax),
+                        offset,
+                        averager,
+                    )
+                    stage.rows += nbaselines * (tmax - tmin)
+
+                pending.discard(task)
+
+    queue.close()
+
+    return uvsum, uvcount
+
+
+def extract_blocks(
+    fluxes,
+    flags,
+    ms,
+    reader,
+    windows,
+    pb_scales,
+    workers,
+    backend,
+    offset=0,
+    report=None,
+    shards=(None,),
+    checkpoint=None,
+    averager=None,
+):
+    """Process windows of row blocks in parallel, writing each window to disk.
+
+    Each target has its own flux dataset, while flags are shared by all targets
+    and written to each of the (possibly empty) list of flag datasets. Windows
+    are written from integration offset along the time axis of the datasets.
+    Each block is split into tasks reading one of the shards of channels.
+    Blocks already completed according to the checkpoint are skipped, and
+    blocks are optionally averaged into bins as they are written.
+    """
+
+    report = report if report is not None else TimingReport()
+    checkpoint = checkpoint or Checkpoint()
+    completed = set(checkpoint.completed)
+
+    nbaselines, _, _, npol = fluxes[0].shape
+    nchan = len(reader.freqs)
+    dtype = fluxes[0].dtype
+
+    # Allocate output cubes spanning the longest window of integrations,
+    # in shared memory only if filled by worker processes
+    shared = backend == "process"
+    if shared:
+        integration_bytes = nbaselines * nchan * npol
+        integration_bytes *= len(fluxes) * np.dtype(dtype).itemsize + bool(flags)
+        windows = fit_shared_memory(windows, integration_bytes)
+
+    window_ntime = get_window_ntime(windows)
+    cube_shape = (len(fluxes), nbaselines, window_ntime, nchan, npol)
+    data_shm, waterfall = create_shared_array(cube_shape, dtype, shared)
+    shms = [data_shm]
+
+    flag_shm, flagcube = None, None
+    if flags:
+        flag_shm, flagcube = create_shared_array(cube_shape[1:], bool, shared)
+        shms.append(flag_shm)
+
+    # UV distance sums are accumulated for each block until it is written
+    uvsum = np.zeros(nbaselines) + np.array(checkpoint.uvsum or 0)
+    uvcount = np.zeros(nbaselines, dtype=int) + np.array(checkpoint.uvcount or 0)
+    block_uvsums = defaultdict(float)
+    block_uvcounts = defaultdict(int)
+
+    Executor = ProcessPoolExecutor if backend == "process" else ThreadPoolExecutor
+    lock = threading.Lock() if backend == "thread" else None
+    cubes = (
+        data_shm.name if shared else waterfall,
+        flag_shm.name if shared and flags else flagcube,
+    )
+    initargs = (ms, reader, cubes, cube_shape, dtype, lock)
+
+    try:
+        with Executor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=initargs,
+        ) as executor:
+            for window in windows:
+                window = [block for block in window if block not in completed]
+                if not window:
+                    continue
+
+                wmin = window[0][2]
+
+                # Missing integrations (e.g. due to correlator dropouts) stay flagged
+                waterfall[:] = np.nan
+                if flagcube is not None:
+                    flagcube[:] = True
+
+                # Submit a task for each shard of channels of each block
+                futures = {
+                    executor.submit(
+                        process_block,
+                        *block[:2],
+                        wmin,
+                        pb_scales,
+                        shard,
+                    ): block
+                    for block in window
+                    for shard in shards
+                }
+                pending = Counter(futures.values())
+
+                # Write the integrations of each block as soon as all of its
+                # shards are complete, overlapping writes with reading of the
+                # remaining blocks
+                for future in as_completed(futures):
+                    block = futures.pop(future)
+                    block_uvsum, block_uvcount, block_report = future.result()
+                    block_uvsums[block] += block_uvsum
+                    block_uvcounts[block] += block_uvcount
+                    report.merge(block_report)
+
+                    pending[block] -= 1
+                    if pending[block] > 0:
+                        continue
+
+                    _, _, tmin, tmax = block
+
+                    with report.time("write") as stage:
+                        stage.bytes_written += write_integrations(
+                            fluxes,
+                            flags,
+                            waterfall,
+                            flagcube,
+                            slice(tmin - wmin, tmax - wmin),
+                            slice(tmin, tmax),
+                            offset,
+                            averager,
+                        )
+                        stage.rows += nbaselines * (tmax - tmin)
+
+                    uvsum += block_uvsums.pop(block)
+                    uvcount += block_uvcounts.pop(block)
+
+                    # Flush block to disk before recording it as complete
+                    if checkpoint.enabled:
+                        for flux in fluxes:
+                            flux.file.flush()
+                        checkpoint.complete(block, uvsum, uvcount)
+    finally:
+        del waterfall, flagcube, cubes
+        for shm in shms:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return uvsum, uvcount
+
+
+def log_read_rate(report, elapsed):
+    """Log throughput of visibilities and flags read from the MS."""
+
+    # Nothing is read when resuming a run whose blocks were all written
+    read_mb = report.stages.get("read", Stage()).bytes_read / 1024**2
+    rate = read_mb / elapsed if elapsed > 0 else 0
+    logger.info(f"Read {read_mb:.1f} MB in {elapsed:.1f} s ({rate:.1f} MB/s)")
+
+    return
+
+
+def extract(
+    datacolumn,
+    phasecentre,
+    catalogue,
+    primary_beam,
+    noflag,
+    baseline_average,
+    minuvdist,
+    tavg,
+    favg,
+    max_memory,
+    workers,
+    backend,
+    freq_shards,
+    chunk_shape,
+    compression,
+    precision,
+    append,
+    cache_dir,
+    cache_size,
+    timing_report,
+    dry_run,
+    scratch_dir,
+    resume,
+    queue,
+    worker,
+    claim_timeout,
+    antennas,
+    timerange,
+    chanrange,
+    correlations,
+    ms,
+    outfile,
+):
+    """Extract DS of one or more targets from an MS."""
+
+    start = time.perf_counter()
+    report = TimingReport()
+
+    columns = {
+        "data": "DATA",
+        "corrected": "CORRECTED_DATA",
+        "model": "MODEL_DATA",
+    }
+    datacolumn = columns[datacolumn]
+    compression = None if compression == "none" else compression
+    dtype = np.complex64 if precision == "single" else np.complex128
+
+    workers = workers or os.cpu_count()
+    queue = TaskQueue(queue, claim_timeout * 60)
+
+    # Run tasks of an extraction coordinated by another process
+    if worker:
+        run_queue_worker(queue, workers)
+        return
+
+    # Optionally rotate phasecentre to new coordinates of one or more targets
+    positions, outfiles = get_targets(phasecentre, catalogue, outfile)
+
+    # Options affecting the output, identifying cached and resumable runs
+    options = {
+        "datacolumn": datacolumn,
+        "positions": positions,
+        "primary_beam": get_path_identity(primary_beam) if primary_beam else None,
+        "noflag": noflag,
+        "baseline_average": baseline_average,
+        "minuvdist": minuvdist if baseline_average else 0,
+        "tavg": tavg,
+        "favg": favg,
+        "chunk_shape": chunk_shape,
+        "compression": compression,
+        "precision": precision,
+        "antennas": antennas,
+        "timerange": timerange,
+        "chanrange": chanrange,
+        "correlations": correlations,
+    }
+
+    # Return products of an identical earlier extraction if cached,
+    # keyed on the MS tables and all options affecting the output
+    cache_key = None
+    if cache_dir is not None and not append and not dry_run:
+        cache_key = get_cache_key(ms, options)
+        if fetch_cache(cache_dir, cache_key, outfiles):
+            return
+
+    # Multiple spectral windows (e.g. VLA) are combined as they are read,
+    # unless they differ in channel count and must be combined with CASA
+    _, _, nchans = get_spectral_windows(ms, chanrange)
+    combine = len(np.unique(nchans)) > 1
+
+    # Keep temporary files of this run in its own scratch directory,
+    # created next to the MS unless given (e.g. on fast local disk),
+    # and only if spectral windows are combined or the run is resumable
+    resume = resume and not dry_run
+    scratch_dir = get_scratch_dir(scratch_dir, ms)
+    resume_options = options | {
+        "append": append,
+        "outfiles": [os.path.abspath(path) for path in outfiles],
+    }
+    temporary = combine and not dry_run
+    with open_scratch(scratch_dir, ms, resume_options, resume, temporary) as scratch:
+        checkpoint = Checkpoint.load(scratch) if resume else Checkpoint()
+
+        if combine and not dry_run:
+            with report.time("combine", children=True):
+                ms = combine_spws(ms, scratch, checkpoint)
+
+        # Check that selected column exists in MS
+        if not validate_datacolumn(ms, datacolumn):
+            logger.error(f"{datacolumn} column does not exist in {ms}")
+            exit(1)
+
+        # Push selection of rows into the table query, and selection of
+        # channels and correlations into the slice of each cell read
+        query = get_selection_query(ms, antennas, timerange)
+        correlation_idx = get_correlation_indices(ms, correlations)
+
+        # Construct header with observation properties for each target
+        header = get_header_properties(ms, datacolumn, 1, None, query, chanrange)
+        headers, pb_scales, phase_offsets = get_target_headers(
+            ms,
+            header,
+            positions,
+            primary_beam,
+        )
+
+        # Calculate final dimensions of DS
+        times, freqs, antenna_idx, nbaselines = get_data_dimensions(
+            ms,
+            query,
+            chanrange,
+        )
+
+        # Optionally average over baselines
+        if baseline_average:
+            logger.debug(f"Averaging over baseline axis with uvdist > {minuvdist}m")
+            nbaselines = 1
+
+        # Flags are applied before averaging over baselines, so the unflagged
+        # average is also stored to allow flags to be ignored when loaded
+        unflagged = baseline_average and not noflag
+
+        # Optionally average channels into bins as they are written, keeping
+        # the frequency of each channel read to rotate its phase
+        averager = BinAverager(tavg, favg)
+        chan_freqs = freqs
+        freqs = averager.bin_frequencies(chan_freqs)
+        headers = [
+            header | averager.attrs | {"channels": len(freqs)} for header in headers
+        ]
+
+        data_shape = (nbaselines, len(times), len(freqs), 4)
+
+        # Optionally append integrations following those already in existing DS,
+        # or resume extracting the integrations of an interrupted run
+        appending = append and any(os.path.exists(path) for path in outfiles)
+        if checkpoint.started:
+            times = np.array(checkpoint.times)
+        elif appending:
+            times = get_append_times(
+                outfiles,
+                headers,
+                times,
+                freqs,
+                data_shape,
+                dtype,
+                noflag,
+                unflagged,
+            )
+            if len(times) == 0:
+                logger.info(f"No integrations in {ms} after those already stored")
+                return
+
+            logger.debug(f"Appending {len(times)} new integrations")
+
+        # Optionally average integrations into bins as they are written
+        bin_times = averager.bin_times(times)
+        headers = [header | averager.attrs for header in headers]
+        data_shape = (nbaselines, len(bin_times), len(freqs), 4)
+
+        # Split time-ordered rows into blocks that fit within memory budget,
+        # by default half of the memory currently available
+        max_memory = get_memory_budget(max_memory)
+        logger.debug(f"Memory budget of {max_memory:.2f} GB")
+        _, chan_offsets, nchans = get_spectral_windows(ms, chanrange)
+        tab = open_time_ordered(ms, query)
+        row_times = tab.getcol("TIME")
+        tab.close()
+
+        # Align blocks with tiles of the data and flag columns
+        tile_rows = get_tile_rows(ms, [datacolumn, "FLAG"])
+
+        # Optionally split the channels of each block between workers, so that
+        # each worker reads and fills its own frequency slab of the output cubes.
+        # Channels are split further if an integration per worker would not
+        # fit within the memory budget
+        min_shards = get_min_shards(
+            max_memory,
+            nchans[0],
+            row_times,
+            workers,
+            dtype,
+            len(outfiles),
+        )
+        shards = get_channel_shards(
+            nchans[0],
+            max(freq_shards, min_shards),
+            chanrange[0] if chanrange else 0,
+            get_tile_channels(ms, [datacolumn, "FLAG"]),
+        )
+        logger.debug(f"Reading channels in {len(shards)} shards")
+
+        # Workers share the concurrent blocks of each window between shards
+        block_workers = get_block_workers(workers, len(shards), min_shards)
+
+        nrows = len(row_times) - np.searchsorted(row_times, times[0])
+        rows_per_block = get_rows_per_block(
+            max_memory,
+            nchans[0],
+            nrows,
+            block_workers,
+            dtype,
+            len(outfiles),
+            tile_rows,
+        )
+        blocks = get_row_blocks(
+            row_times,
+            times,
+            rows_per_block,
+            tile_rows,
+            averager.time_bins,
+        )
+        logger.debug(
+            f"Reading {nrows} rows in {len(blocks)} blocks aligned to {tile_rows} row tiles"
+        )
+
+        # Stream blocks within the memory budget, with each window holding
+        # the blocks read concurrently by workers
+        window_size = block_workers
+        windows = [
+            blocks[i : i + window_size] for i in range(0, len(blocks), window_size)
+        ]
+
+        # Optionally predict resource usage and stop before extracting
+        if dry_run:
+            estimate = estimate_resources(
+                ms,
+                data_shape,
+                len(outfiles),
+                windows,
+                nchans[0],
+                workers,
+                dtype,
+                noflag,
+                combine,
+                len(chan_freqs),
+            )
+            log_dry_run(
+                header,
+                estimate,
+                data_shape,
+                dtype,
+                chunk_shape,
+                max_memory,
+                nchans[0],
+                row_times,
+                len(outfiles),
+            )
+            return
+
+        reader = RowReader(
+            datacolumn=datacolumn,
+            times=times,
+            freqs=chan_freqs,
+            lookup=get_baseline_lookup(ms, antenna_idx, baseline_average),
+            chan_offsets=chan_offsets,
+            phase_offsets=phase_offsets,
+            noflag=noflag,
+            baseline_average=baseline_average,
+            minuvdist=minuvdist,
+            query=query,
+            chanrange=chanrange,
+            correlations=correlation_idx,
+            weightcolumn=get_weight_column(ms),
+        )
+
+        # Resume writing the row blocks planned by an interrupted run
+        if checkpoint.started:
+            windows = checkpoint.windows
+            logger.info(
+                f"Resuming extraction with {len(checkpoint.completed)} of"
+                f" {sum(len(window) for window in windows)} row blocks complete"
+            )
+
+        # Stream each window of blocks into 4D data cube of each target on disk
+        with ExitStack() as stack:
+            offset, datasets = open_datasets(
+                stack,
+                outfiles,
+                headers,
+                bin_times,
+                freqs,
+                data_shape,
+                dtype,
+                chunk_shape,
+                compression,
+                noflag,
+                appending,
+                checkpoint,
+                unflagged,
+            )
+            uvdists, fluxes, flags, unflagged_fluxes = zip(*datasets)
+
+            # Unflagged averages are written as further targets following
+            # those with flags applied
+            if unflagged:
+                fluxes += unflagged_fluxes
+                pb_scales = np.tile(pb_scales, 2)
+
+            # UV distances of this run are summed with those of rows already
+            # stored, so that writing them is repeatable if the run is resumed
+            if not checkpoint.started:
+                checkpoint.start(times, offset, windows, *read_uvdist(uvdists[0]))
+
+            # Optionally share row blocks with workers on other nodes
+            extract_start = time.perf_counter()
+            flags = [target_flags for target_flags in flags if target_flags is not None]
+            if queue.path is not None:
+                uvsum, uvcount = extract_queue(
+                    fluxes,
+                    flags,
+                    ms,
+                    reader,
+                    [block for window in windows for block in window],
+                    pb_scales,
+                    workers,
+                    queue,
+                    offset,
+                    report,
+                    averager,
+                    checkpoint,
+                )
+            else:
+                uvsum, uvcount = extract_blocks(
+                    fluxes,
+                    flags,
+                    ms,
+                    reader,
+                    windows,
+                    pb_scales,
+                    workers,
+                    backend,
+                    offset,
+                    report,
+                    shards if len(shards) > 1 else (None,),
+                    checkpoint,
+                    averager,
+                )
+            # Only mark integrations complete once all are written, so that
+            # a failed append is retried from the same integration
+            for uvdist in uvdists:
+                write_uvdist(uvdist, uvsum, uvcount)
+                uvdist.file.attrs["last_integration"] = times[-1]
+                uvdist.file.flush()
+
+            log_read_rate(report, time.perf_counter() - extract_start)
+
+        if cache_key is not None:
+            store_cache(cache_dir, cache_key, outfiles, cache_size)
+
+        # Report time spent in each stage, with worker stages summed over all workers
+        report.stages["total"] = Stage(
+            wall=time.perf_counter() - start,
+            rows=int(nrows),
+            bytes_read=report.stages.get("read", Stage()).bytes_read,
+            bytes_written=sum(os.path.getsize(path) for path in outfiles),
+            peak_rss=get_peak_rss(),
+        )
+        report.log()
+        if timing_report:
+            report.write(Path(outfile).with_suffix(".timing.json"))
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--datacolumn",
+    type=click.Choice(["data", "corrected", "model"]),
+    default="data",
+    help="Selection of DATA, CORRECTED_DATA, or MODEL column.",
+)
+@click.option(
+    "-p",
+    "--phasecentre",
+    type=str,
+    nargs=2,
+    default=None,
+    help="RA and Dec of phasecentre at which to extract DS.",
+)
+@click.option(
+    "-c",
+    "--catalogue",
+    type=click.Path(exists=True),
+    default=None,
+    help="CSV catalogue with name, ra, and dec columns of targets to extract in a single pass, writing one DS per target named <DS>_<name>.",
+)
+@click.option(
+    "-P",
+    "--primary-beam",
+    type=click.Path(),
+    default=None,
+    help="Path to primary beam image with which to correct flux scale. Must also provide phasecentre or catalogue.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Save progress in the scratch directory so that if extraction is interrupted (e.g. by preemption), running it again with the same options resumes from where it stopped.",
+)
+@click.option(
+    "--queue",
+    type=click.Path(),
+    default=None,
+    help="Directory on a shared filesystem through which blocks of rows are shared with worker processes on other nodes, started with --worker and the same --queue.",
+)
+@click.option(
+    "--worker",
+    is_flag=True,
+    default=False,
+    help="Run tasks of an extraction coordinated through --queue by another process, rather than extracting the DS.",
+)
+@click.option(
+    "--claim-timeout",
+    type=float,
+    default=60,
+    help="Minutes after which a task claimed through --queue without a result is run again, e.g. if its node failed.",
+)
+@click.option(
+    "--antennas",
+    type=str,
+    default=None,
+    help="Comma-separated names or indices of antennas to extract.",
+)
+@click.option(
+    "--timerange",
+    type=str,
+    nargs=2,
+    default=None,
+    help="Start and end time of integrations to extract as MJD or ISO format (e.g. 2024-01-01T00:00:00).",
+)
+@click.option(
+    "--chanrange",
+    type=int,
+    nargs=2,
+    default=None,
+    help="First and last channel to extract, applied to each spectral window.",
+)
+@click.option(
+    "--correlations",
+    type=str,
+    default=None,
+    help="Comma-separated correlations to extract (e.g. XX,YY for Stokes I or XY,YX for Stokes V with linear feeds), leaving others missing.",
+)
+@click.option(
+    "-F",
+    "--noflag",
+    is_flag=True,
+    default=False,
+    help="Ignore flags, neither applying them when averaging baselines nor storing them.",
+)
+@click.option(
+    "-B",
+    "--baseline-average",
+    is_flag=True,
+    default=True,
+    flag_value=False,
+    help="Disable averaging over baseline axis.",
+)
+@click.option(
+    "-u",
+    "--minuvdist",
+    type=float,
+    default=0,
+    help="Minimum UV distance in meters to retain if averaging over baseline axis.",
+)
+@click.option(
+    "-t",
+    "--tavg",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Average integrations into bins of this many as they are extracted, restarting bins at each scan.",
+)
+@click.option(
+    "-f",
+    "--favg",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Average channels into bins of this many as they are extracted, as with plot_ds -f.",
+)
+@click.option(
+    "-M",
+    "--max-memory",
+    type=float,
+    default=None,
+    help="Memory budget in GB for reading visibilities, streaming the MS to disk in row blocks and splitting channels of large integrations between workers. Defaults to half of the available memory.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of workers reading visibilities in parallel. Defaults to number of CPUs.",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["process", "thread"]),
+    default="process",
+    help="Run workers as separate processes or as threads.",
+)
+@click.option(
+    "--freq-shards",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of channel ranges to split each block of rows into, read and filled by separate workers. Keeps all workers busy when there are few blocks, e.g. with wide-band data averaged over baselines.",
+)
+@click.option(
+    "--chunk-shape",
+    type=int,
+    nargs=2,
+    default=(256, 64),
+    help="Number of integrations and channels in each HDF5 chunk of the output DS.",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["lzf", "gzip", "none"]),
+    default="lzf",
+    help="Compression filter applied to the output DS along with byte-shuffling.",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(["double", "single"]),
+    default="double",
+    help="Store DS as complex128 (double) or complex64 (single) precision.",
+)
+@click.option(
+    "-a",
+    "--append",
+    is_flag=True,
+    default=False,
+    help="Append integrations following those already stored in an existing DS, which must share its frequencies and header.",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False),
+    envvar="DSTOOLS_CACHE_DIR",
+    default=None,
+    help="Directory in which to cache DS, returning cached DS for repeated extractions with identical MS and options. Can also be set with DSTOOLS_CACHE_DIR.",
+)
+@click.option(
+    "--cache-size",
+    type=float,
+    default=100,
+    help="Maximum size of cache in GB, beyond which least recently used DS are evicted.",
+)
+@click.option(
+    "--timing-report",
+    is_flag=True,
+    default=False,
+    help="Write wall time, throughput, and peak memory of each extraction stage to <DS>.timing.json.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Predict memory, temporary disk, and output size and recommend settings without extracting.",
+)
+@click.option(
+    "--scratch-dir",
+    type=click.Path(exists=True, file_okay=False),
+    default=None,
+    help="Directory in which to create a scratch directory for temporary files of this run (e.g. on fast local disk or tmpfs). Defaults to directory of MS, or the system temporary directory if that is not writable.",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    default=False,
+    help="Enable verbose logging.",
+)
+@click.argument("ms")
+@click.argument("outfile")
+def main(verbose, **kwargs):
+
+    setupLogger(verbose=verbose)
+
+    extract(**kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+import logging
+import os
+import shlex
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import pandas as pd
+
+from dstools.cli.extract_ds import extract, get_memory_budget
+from dstools.cli.extract_ds import main as extract_ds
+from dstools.logger import setupLogger
+
+logger = logging.getLogger(__name__)
+
+
+def read_manifest(manifest):
+    """Read MS, output path, and extraction options of each job from CSV manifest."""
+
+    jobs = pd.read_csv(manifest, dtype=str, keep_default_na=False)
+    jobs.columns = jobs.columns.str.strip().str.lower()
+
+    if not {"ms", "outfile"}.issubset(jobs.columns):
+        raise ValueError(f"Manifest {manifest} must contain ms and outfile columns.")
+
+    if "options" not in jobs.columns:
+        jobs["options"] = ""
+
+    return jobs[["ms", "outfile", "options"]].to_dict("records")
+
+
+def get_logfile(outfile, logdir):
+    """Construct path of job log, stored alongside the DS unless a log directory is given."""
+
+    path = Path(outfile)
+    logdir = path.parent if logdir is None else Path(logdir)
+
+    return str(logdir / f"{path.stem}.log")
+
+
+def run_job(ms, outfile, options, logfile, workers, max_memory, verbose):
+    """Extract DS from a single MS within this process, logging to its own file."""
+
+    setupLogger(verbose=verbose, filename=logfile, stream=False)
+
+    # Parse job options as on the command line, where options set
+    # in the manifest override the default worker count and memory budget
+    args = [
+        "-w",
+        str(workers),
+        "-M",
+        str(max_memory),
+        *shlex.split(options),
+        ms,
+        outfile,
+    ]
+
+    try:
+        ctx = extract_ds.make_context("dstools-extract-ds", args)
+        params = dict(ctx.params)
+        params.pop("verbose")
+
+        logger.info(f"Extracting DS from {ms} to {outfile}")
+        extract(**params)
+        logger.info(f"Finished extracting DS from {ms}")
+    except (Exception, SystemExit) as e:
+        logger.exception(f"Extraction from {ms} failed")
+        return f"{type(e).__name__}: {e}"
+    finally:
+        # Release job log as this process moves on to the next job
+        for handler in logging.getLogger().handlers:
+            handler.close()
+
+    return
+
+
+@click.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Number of MeasurementSets to extract concurrently.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of workers reading visibilities within each job. Defaults to number of CPUs shared between jobs.",
+)
+@click.option(
+    "-M",
+    "--max-memory",
+    type=float,
+    default=None,
+    help="Memory budget in GB of each job. Defaults to half of the available memory shared between jobs.",
+)
+@click.option(
+    "-l",
+    "--logdir",
+    type=click.Path(file_okay=False),
+    default=None,
+    help="Directory in which to store job logs. Defaults to directory of each DS.",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    default=False,
+    help="Enable verbose logging.",
+)
+@click.argument("manifest", type=click.Path(exists=True))
+def main(jobs, workers, max_memory, logdir, verbose, manifest):
+    """Extract DS from each MS listed in a CSV manifest with ms, outfile, and options columns."""
+
+    setupLogger(verbose=verbose)
+
+    manifest = read_manifest(manifest)
+    workers = workers or max(os.cpu_count() // jobs, 1)
+    max_memory = get_memory_budget(max_memory, jobs)
+
+    if logdir is not None:
+        os.makedirs(logdir, exist_ok=True)
+
+    logger.info(f"Extracting {len(manifest)} DS with {jobs} concurrent jobs")
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        processes = {
+            executor.submit(
+                run_job,
+                job["ms"],
+                job["outfile"],
+                job["options"],
+                get_logfile(job["outfile"], logdir),
+                workers,
+                max_memory,
+                verbose,
+            ): job
+            for job in manifest
+        }
+
+        # Continue past failed jobs, reporting them as they complete
+        for process in as_completed(processes):
+            job = processes[process]
+            logfile = get_logfile(job["outfile"], logdir)
+
+            try:
+                error = process.result()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+
+            if error is None:
+                logger.info(f"Extracted {job['outfile']} from {job['ms']}")
+            else:
+                logger.error(f"Failed {job['ms']} ({error}), see {logfile}")
+                failures.append(job["ms"])
+
+    logger.info(f"{len(manifest) - len(failures)} of {len(manifest)} jobs succeeded")
+
+    if failures:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -191,6 +191,13 @@ stokes_choices = [
     default=True,
     help="Remove flagged channels at top/bottom of band.",
 )
+@click.option(
+    "-N",
+    "--noflag",
+    is_flag=True,
+    default=False,
+    help="Ignore flags stored with the DS.",
+)
 @click.option(
     "-F",
     "--fold",
@@ -263,6 +270,7 @@ def main(
     fold,
     derotate,
     trim,
+    noflag,
     period,
     period_offset,
     calscans,
@@ -296,6 +304,7 @@ def main(
         maxtime=tmax,
         tunit=tunit,
         trim=trim,
+        noflag=noflag,
         calscans=calscans,
         derotate=derotate,
         fold=fold,
@@ -107,6 +107,7 @@ def rebin2D(array, new_shape):
     """Re-bin along time / frequency axes conserving flux."""
 
     if new_shape == array.shape:
+        array = np.asarray(array)
         array[array == 0 + 0j] = np.nan
         return array
 
@@ -115,8 +116,10 @@ def rebin2D(array, new_shape):
             "New shape should not be greater than old shape in either dimension"
         )
 
-    time_comp = rebin(array.shape[0], new_shape[0], axis=0)
-    freq_comp = rebin(array.shape[1], new_shape[1], axis=1)
+    # Match compressor precision to data to avoid upcasting single precision
+    dtype = array.real.dtype
+    time_comp = rebin(array.shape[0], new_shape[0], axis=0).astype(dtype)
+    freq_comp = rebin(array.shape[1], new_shape[1], axis=1).astype(dtype)
     array[np.isnan(array)] = 0 + 0j
     result = time_comp @ np.array(array) @ freq_comp
     result[result == 0 + 0j] = np.nan
@@ -124,6 +127,15 @@ def rebin2D(array, new_shape):
     return result
 
 
+def unpack_flags(packed, shape):
+    """Unpack flags bit-packed along channel / polarisation axis into given shape."""
+
+    nchan, npol = shape[-2:]
+    flags = np.unpackbits(packed, axis=-1, count=nchan * npol)
+
+    return flags.reshape(shape).astype(bool)
+
+
 def slice_array(a, ax1_min, ax1_max, ax2_min=None, ax2_max=None):
     """Slice 1D or 2D array with variable lower and upper boundaries."""
 
@@ -206,6 +218,9 @@ class DynamicSpectrum:
 
     calscans: bool = True
     trim: bool = True
+    noflag: bool = False
+
+    chunk_cache: float = 64
 
     def __post_init__(self):
 
@@ -261,11 +276,19 @@ class DynamicSpectrum:
         # Create left-padded nans, derived from period phase offset
         offset = (0.5 + self.period_offset) * self.period
         leftpad_length = int(offset // pixel_duration)
-        leftpad_chunk = np.full((leftpad_length, data.shape[1]), np.nan)
+        leftpad_chunk = np.full(
+            (leftpad_length, data.shape[1]),
+            np.nan,
+            dtype=data.dtype,
+        )
 
         # Create right-padded nans
         rightpad_length = chunk_length - (leftpad_length + len(data)) % chunk_length
-        rightpad_chunk = np.full((rightpad_length, data.shape[1]), np.nan)
+        rightpad_chunk = np.full(
+            (rightpad_length, data.shape[1]),
+            np.nan,
+            dtype=data.dtype,
+        )
 
         # Stack and split data
         data = np.vstack((leftpad_chunk, data, rightpad_chunk))
@@ -320,29 +343,78 @@ class DynamicSpectrum:
             self.minuvwave = 0
             self.maxuvwave = np.inf
 
+        # Flags are applied before averaging over baselines, or in time / frequency
+        # at extraction, so cannot be ignored unless the unflagged average is stored
+        averaged = (
+            baseline_averaged
+            or datafile.attrs.get("tavg", 1) > 1
+            or datafile.attrs.get("favg", 1) > 1
+        )
+        unflagged = "flux_noflag" in datafile
+        if self.noflag and averaged and "flags" in datafile and not unflagged:
+            logger.warning(
+                "DS was averaged with flags applied, extract with flagging disabled to ignore flags."
+            )
+
         return
 
     def _load_data(self):
         """Load instrumental pols and uvdist/time/freq data, converting to MHz, s, and mJy."""
 
         # Import instrumental polarisations and time/frequency/uvdist arrays
-        with h5py.File(self.ds_path, "r") as f:
+        with h5py.File(
+            self.ds_path,
+            "r",
+            rdcc_nbytes=int(self.chunk_cache * 1024**2),
+        ) as f:
 
             self._validate(f)
 
             # Read header
             self.header = dict(f.attrs)
 
-            # Read uvdist, time, frequency, and flux arrays
+            # Integrations averaged at extraction are spaced further apart
+            self.corr_dumptime *= self.header.get("tavg", 1)
+
+            # Read uvdist, time, and frequency arrays
             uvdist = f["uvdist"][:]
             time = f["time"][:]
             freq = f["frequency"][:] / 1e6
-            flux = f["flux"][:] * 1e3
+
+            # Set timescale
+            time_scale_factor = self.tunit.to(u.s)
+            time /= time_scale_factor
+            self.corr_dumptime /= time_scale_factor
+            self._timelabel = "Phase" if self.fold else f"Time ({self.tunit})"
+
+            # Select time range
+            if self.mintime:
+                mintime = np.argmax(time - time[0] > self.mintime)
+            else:
+                mintime = 0
+
+            if self.maxtime:
+                maxtime = -np.argmax((time - time[0] < self.maxtime)[::-1]) + 1
+            else:
+                maxtime = 0
 
             # Make baseline selection using UV distance
             blmask = (uvdist >= self.minuvdist) & (uvdist <= self.maxuvdist)
             uvdist = uvdist[blmask]
-            flux = flux[blmask, :, :, :]
+
+            # Read flux of selected baselines and time range only,
+            # so that only the required chunks are read from disk
+            blselection = slice(None) if blmask.all() else np.flatnonzero(blmask)
+            tselection = slice(mintime, maxtime if maxtime != 0 else None)
+            flux_dataset = (
+                "flux_noflag" if self.noflag and "flux_noflag" in f else "flux"
+            )
+            flux = f[flux_dataset][blselection, tselection] * 1e3
+
+            # Apply flags stored alongside the visibilities
+            if not self.noflag and "flags" in f:
+                flags = f["flags"][blselection, tselection]
+                flux[unpack_flags(flags, flux.shape)] = np.nan
 
             # Construct array of UV distance in units of wavelength
             wavelength = (freq * u.MHz).to(u.m, equivalencies=u.spectral()).value
@@ -350,7 +422,7 @@ class DynamicSpectrum:
             wavelength_expanded = wavelength[np.newaxis, np.newaxis, :, np.newaxis]
             uvwave = np.tile(
                 uvdist_expanded / wavelength_expanded,
-                (1, len(time), 1, 4),
+                (1, flux.shape[1], 1, 4),
             )
 
             uvwave_mask = (uvwave <= self.minuvwave) | (uvwave >= self.maxuvwave)
@@ -370,12 +442,6 @@ class DynamicSpectrum:
             YX = flux[:, :, 2]
             YY = flux[:, :, 3]
 
-        # Set timescale
-        time_scale_factor = self.tunit.to(u.s)
-        time /= time_scale_factor
-        self.corr_dumptime /= time_scale_factor
-        self._timelabel = "Phase" if self.fold else f"Time ({self.tunit})"
-
         # Flip ATCA L-band frequency axis to intuitive order
         if freq[0] > freq[-1]:
             XX = np.flip(XX, axis=1)
@@ -408,17 +474,6 @@ class DynamicSpectrum:
         if self.maxfreq:
             maxchan = np.argmax(freq > self.maxfreq)
 
-        # Select time range
-        if self.mintime:
-            mintime = np.argmax(time - time[0] > self.mintime)
-        else:
-            mintime = 0
-
-        if self.maxtime:
-            maxtime = -np.argmax((time - time[0] < self.maxtime)[::-1]) + 1
-        else:
-            maxtime = 0
-
         # Identify start time and set observation start to t=0
         time_start = Time(
             time[0] * time_scale_factor / 3600 / 24,
@@ -429,11 +484,11 @@ class DynamicSpectrum:
         self.header["time_start"] = time_start
         time -= time[0]
 
-        # Make data selection
-        XX = slice_array(XX, mintime, maxtime, minchan, maxchan)
-        XY = slice_array(XY, mintime, maxtime, minchan, maxchan)
-        YX = slice_array(YX, mintime, maxtime, minchan, maxchan)
-        YY = slice_array(YY, mintime, maxtime, minchan, maxchan)
+        # Make data selection, with time range already selected on read
+        XX = slice_array(XX, 0, 0, minchan, maxchan)
+        XY = slice_array(XY, 0, 0, minchan, maxchan)
+        YX = slice_array(YX, 0, 0, minchan, maxchan)
+        YY = slice_array(YY, 0, 0, minchan, maxchan)
 
         self.uvdist = uvdist
         self.freq = slice_array(freq, minchan, maxchan)
@@ -469,7 +524,7 @@ class DynamicSpectrum:
         # Create initial time-slice to start stacking target and calibrator scans together
         new_data_XX = new_data_XY = new_data_YX = new_data_YY = np.zeros(
             (1, num_channels),
-            dtype=complex,
+            dtype=XX.dtype,
         )
         new_time = np.zeros(1)
 
@@ -487,7 +542,7 @@ class DynamicSpectrum:
             # and append to each on-target chunk of data
             if self.calscans and num_scans > 0:
                 num_nans = (int(round(num_scans) - 1), num_channels)
-                nan_chunk = np.full(num_nans, np.nan + np.nan * 1j)
+                nan_chunk = np.full(num_nans, np.nan + np.nan * 1j, dtype=XX.dtype)
 
                 XX_chunk = np.ma.vstack([XX_chunk, nan_chunk])
                 XY_chunk = np.ma.vstack([XY_chunk, nan_chunk])
@@ -686,7 +741,7 @@ class DynamicSpectrum:
         """Correct linear polarisation DS for Faraday rotation."""
 
         lam = (c.c / (self.freq * u.MHz)).to(u.m).value
-        L = L * np.exp(-2j * RM * lam**2)
+        L = L * np.exp(-2j * RM * lam**2).astype(L.dtype)
 
         return L
 
@@ -4,7 +4,11 @@ from typing import Optional
 import colorlog
 
 
-def setupLogger(verbose: bool, filename: Optional[str] = None) -> None:
+def setupLogger(
+    verbose: bool,
+    filename: Optional[str] = None,
+    stream: bool = True,
+) -> None:
     level = logging.DEBUG if verbose else logging.INFO
 
     # Get root logger disable any existing handlers, and set level
@@ -28,6 +32,9 @@ def setupLogger(verbose: bool, filename: Optional[str] = None) -> None:
         file_handler.setFormatter(formatter)
         root_logger.addHandler(file_handler)
 
+    if not stream:
+        return
+
     colorformatter = colorlog.ColoredFormatter(
         "%(log_color)s%(levelname)-8s%(reset)s %(asctime)s - %(name)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
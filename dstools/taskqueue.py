@@ -0,0 +1,182 @@
+import logging
+import os
+import pickle
+import shutil
+import socket
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, content):
+    """Write bytes to path via a uniquely named partial file, so readers never see partial writes."""
+
+    partial = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}")
+    partial.write_bytes(content)
+    os.replace(partial, path)
+
+    return
+
+
+@dataclass
+class TaskQueue:
+    """Tasks shared between processes on many nodes through a directory on a shared filesystem.
+
+    Tasks are claimed by exclusively creating a lock file, so each is normally
+    run once. A task claimed longer than claim_timeout seconds ago without a
+    result (e.g. as its node failed) may be claimed again, so results must not
+    depend on which process ran them.
+    """
+
+    path: Optional[Path]
+    claim_timeout: float = 3600
+    poll: float = 5
+
+    def __post_init__(self):
+        if self.path is not None:
+            self.path = Path(self.path)
+
+    @property
+    def plan_path(self):
+        return self.path / "plan.pkl"
+
+    @property
+    def complete(self):
+        return (self.path / "complete").exists()
+
+    def create(self, plan):
+        """Publish plan holding a list of tasks, clearing any earlier run of the queue."""
+
+        for name in ["claims", "results"]:
+            shutil.rmtree(self.path / name, ignore_errors=True)
+            (self.path / name).mkdir(parents=True)
+
+        (self.path / "complete").unlink(missing_ok=True)
+        write_atomic(self.plan_path, pickle.dumps(plan))
+
+        return
+
+    def load_plan(self):
+        """Wait for a plan to be published, returning None if the queue is already complete."""
+
+        while not self.plan_path.exists():
+            if self.complete:
+                return None
+            time.sleep(self.poll)
+
+        # The plan is removed once the queue is closed
+        try:
+            return pickle.loads(self.plan_path.read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def claim(self, task):
+        """Claim a task, returning whether this process should run it.
+
+        No tasks are left to claim once the queue is complete, as its
+        claims may already be removed.
+        """
+
+        if self.complete or self.has_result(task):
+            return False
+
+        claim = self.path / "claims" / str(task)
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileNotFoundError:
+            return False
+        except FileExistsError:
+            # Reclaim tasks of processes that appear to have failed
+            try:
+                age = time.time() - claim.stat().st_mtime
+            except FileNotFoundError:
+                return False
+
+            if age < self.claim_timeout:
+                return False
+
+            # Only one process can move a stale claim aside to claim the task again
+            stale = claim.with_name(f".{task}.{socket.gethostname()}.{os.getpid()}")
+            try:
+                os.rename(claim, stale)
+            except FileNotFoundError:
+                return False
+
+            stale.unlink(missing_ok=True)
+            logger.warning(f"Reclaiming task {task} claimed {age:.0f} s ago")
+
+            return self.claim(task)
+
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{socket.gethostname()} {os.getpid()}")
+
+        return True
+
+    def claim_next(self, ntasks):
+        """Claim the first available of ntasks tasks, or return None if none are left."""
+
+        for task in range(ntasks):
+            if self.claim(task):
+                return task
+
+        return None
+
+    def has_result(self, task):
+        results = self.path / "results"
+        return (results / f"{task}.pkl").exists() or (
+            results / f"{task}.merged"
+        ).exists()
+
+    def store_result(self, task, result):
+        """Store the result of a task, returning False if the queue completed without it.
+
+        This happens when a reclaimed task finishes late, after the result of
+        another run of it was merged.
+        """
+
+        if self.complete:
+            return False
+
+        try:
+            write_atomic(self.path / "results" / f"{task}.pkl", pickle.dumps(result))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def ready(self, tasks):
+        """Get tasks with results waiting to be merged."""
+
+        return [
+            task for task in tasks if (self.path / "results" / f"{task}.pkl").exists()
+        ]
+
+    def pop_result(self, task):
+        """Load the result of a task, marking it as merged so it is not run again."""
+
+        result_path = self.path / "results" / f"{task}.pkl"
+        result = pickle.loads(result_path.read_bytes())
+
+        (self.path / "results" / f"{task}.merged").touch()
+        result_path.unlink()
+
+        return result
+
+    def close(self):
+        """Mark queue complete, so that waiting workers exit, then remove its tasks.
+
+        The queue is marked complete first so that workers still claiming tasks
+        or storing results stop, rather than finding their directories removed.
+        """
+
+        (self.path / "complete").touch()
+
+        for name in ["claims", "results"]:
+            shutil.rmtree(self.path / name, ignore_errors=True)
+
+        self.plan_path.unlink(missing_ok=True)
+
+        return
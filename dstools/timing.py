@@ -0,0 +1,134 @@
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# Peak resident set size of this process before its high-water mark was last reset
+_reset_peak_rss = 0
+
+
+def read_hwm():
+    """Read resident set size high-water mark in bytes from /proc, if available (Linux)."""
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def reset_hwm():
+    """Reset resident set size high-water mark of this process, returning whether it was reset."""
+
+    global _reset_peak_rss
+
+    hwm = read_hwm()
+    if hwm is None:
+        return False
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+
+    _reset_peak_rss = max(_reset_peak_rss, hwm)
+
+    return True
+
+
+def get_peak_rss(children=False):
+    """Get peak resident set size in bytes over the lifetime of this process or its waited-for children."""
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+
+    # ru_maxrss is reported in kB on Linux, and is lowered along with
+    # the high-water mark when reset
+    peak_rss = resource.getrusage(who).ru_maxrss * 1024
+    if children:
+        return peak_rss
+
+    return max(peak_rss, _reset_peak_rss, read_hwm() or 0)
+
+
+@dataclass
+class Stage:
+    """Accumulated wall time, throughput, and peak memory of a processing stage.
+
+    Peak memory is measured over the stage where the high-water mark of the
+    process can be reset (Linux), and is otherwise the peak of the process
+    lifetime up to the end of the stage.
+    """
+
+    wall: float = 0
+    rows: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss: int = 0
+
+
+@dataclass
+class TimingReport:
+    """Per-stage timing of a processing run, which can be merged across workers."""
+
+    stages: dict[str, Stage] = field(default_factory=dict)
+
+    @contextmanager
+    def time(self, name, children=False):
+        """Time a stage, yielding it so that rows and bytes processed can be added."""
+
+        stage = self.stages.setdefault(name, Stage())
+
+        # Stages running concurrently in threads share the high-water mark,
+        # so each measures the peak since the latest of them started
+        reset = not children and reset_hwm()
+
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall += time.perf_counter() - start
+            peak_rss = (read_hwm() or 0) if reset else get_peak_rss(children)
+            stage.peak_rss = max(stage.peak_rss, peak_rss)
+
+    def merge(self, other):
+        """Add stages timed in another report, e.g. by a worker process."""
+
+        for name, other_stage in other.stages.items():
+            stage = self.stages.setdefault(name, Stage())
+            stage.wall += other_stage.wall
+            stage.rows += other_stage.rows
+            stage.bytes_read += other_stage.bytes_read
+            stage.bytes_written += other_stage.bytes_written
+            stage.peak_rss = max(stage.peak_rss, other_stage.peak_rss)
+
+        return
+
+    def log(self):
+        for name, stage in self.stages.items():
+            rate = stage.rows / stage.wall if stage.wall > 0 else 0
+            logger.info(
+                f"{name:<10} {stage.wall:8.2f} s {rate:12.0f} rows/s "
+                f"{stage.bytes_read / 1024**2:10.1f} MB read "
+                f"{stage.bytes_written / 1024**2:10.1f} MB written "
+                f"{stage.peak_rss / 1024**2:10.1f} MB peak RSS"
+            )
+
+        return
+
+    def write(self, path):
+        """Write report to a JSON file."""
+
+        stages = {name: asdict(stage) for name, stage in self.stages.items()}
+        with open(path, "w") as f:
+            json.dump(stages, f, indent=2, default=int)
+
+        return